@@ -0,0 +1,229 @@
+import os
+import threading
+import time
+import wave
+from collections import deque
+from mp3 import frame_offsets
+
+try:
+    import miniaudio
+except ImportError:
+    miniaudio = None # 未安装时 AudioPlayer 使用 ffplay 播放
+
+OUTPUT_RATE = 44100 # 输出采样率（ElevenLabs 默认输出 mp3_44100_128）
+CHANNELS = 1
+SAMPLE_BYTES = 2 # 16 位 PCM
+FRAME_BYTES = CHANNELS * SAMPLE_BYTES
+BLOCK_FRAMES = 441 # 每次回调输出的帧数（10 毫秒）
+RING_SECONDS = 30 # 环形缓冲容量（秒）
+PRIME_FRAMES = 2 # 流式解码时带上前一批最后几个 MP3 帧，补全比特池
+CLOCK_INTERVAL = 0.01 # 推进播放时钟的间隔（秒）
+AUDIO_SINK = os.getenv("AUDIO_SINK", "") # 空：声卡（pyaudio）；null：按实时速度丢弃；*.wav：写入文件
+
+def decode(data: bytes) -> bytes:
+    # 在进程内把 MP3 解码成输出格式的 PCM
+    decoded = miniaudio.decode(bytes(data), output_format=miniaudio.SampleFormat.SIGNED16, nchannels=CHANNELS, sample_rate=OUTPUT_RATE)
+    return decoded.samples.tobytes()
+
+class RingBuffer:
+    # 固定容量的 PCM 环形缓冲：解码线程写入，输出回调读取
+    def __init__(self, capacity: int):
+        self.data = bytearray(capacity)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def write(self, pcm: bytes):
+        # 写入 PCM，缓冲满时等待回调读走
+        view = memoryview(pcm)
+        while view:
+            with self.condition:
+                self.condition.wait_for(lambda: self.size < self.capacity)
+                count = min(len(view), self.capacity - self.size)
+                end = (self.start + self.size) % self.capacity
+                first = min(count, self.capacity - end)
+                self.data[end:end + first] = view[:first]
+                self.data[:count - first] = view[first:count]
+                self.size += count
+            view = view[count:]
+
+    def read(self, size: int) -> bytes:
+        # 读出最多 size 字节
+        with self.condition:
+            size = min(size, self.size)
+            first = min(size, self.capacity - self.start)
+            pcm = bytes(self.data[self.start:self.start + first]) + bytes(self.data[:size - first])
+            self.start = (self.start + size) % self.capacity
+            self.size -= size
+            self.condition.notify_all()
+            return pcm
+
+class NullSink:
+    # 无声卡输出：按实时速度取数据并丢弃，用于测量延迟和间隙
+    def start(self, callback):
+        self.callback = callback
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        period = BLOCK_FRAMES / OUTPUT_RATE
+        next_time = time.perf_counter()
+        while True:
+            self.write(self.callback(BLOCK_FRAMES))
+            next_time += period
+            time.sleep(max(0, next_time - time.perf_counter()))
+
+    def write(self, pcm: bytes):
+        pass
+
+class FileSink(NullSink):
+    # 按实时速度把输出写入 WAV 文件
+    def __init__(self, path: str):
+        self.file = wave.open(path, "wb")
+        self.file.setnchannels(CHANNELS)
+        self.file.setsampwidth(SAMPLE_BYTES)
+        self.file.setframerate(OUTPUT_RATE)
+
+    def write(self, pcm: bytes):
+        self.file.writeframes(pcm)
+
+class PyAudioSink:
+    # 声卡输出：常驻的 pyaudio 输出流，由回调取数据
+    def start(self, callback):
+        import pyaudio
+
+        def stream_callback(in_data, frame_count, time_info, status):
+            return callback(frame_count), pyaudio.paContinue
+
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(
+            format=pyaudio.paInt16,
+            channels=CHANNELS,
+            rate=OUTPUT_RATE,
+            output=True,
+            frames_per_buffer=BLOCK_FRAMES,
+            stream_callback=stream_callback,
+        )
+        self.stream.start_stream()
+
+def make_sink():
+    # 按 AUDIO_SINK 选择输出
+    if AUDIO_SINK == "null":
+        return NullSink()
+    if AUDIO_SINK.endswith(".wav"):
+        return FileSink(AUDIO_SINK)
+    return PyAudioSink()
+
+class OutputEngine:
+    # 进程内音频输出：MP3 解码成 PCM 写入环形缓冲，常驻输出流回调读取，片段之间无缝衔接
+    def __init__(self, clock, sink=None):
+        if miniaudio is None:
+            raise ValueError("需要安装 miniaudio 才能使用进程内播放！")
+        self.clock = clock # 按实际输出的帧数推进
+        self.ring = RingBuffer(RING_SECONDS * OUTPUT_RATE * FRAME_BYTES)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock() # 保证片段按提交顺序写入
+        self.stream_tail = b"" # 上一批流式数据的最后几帧
+        self.written = 0 # 写入环形缓冲的总帧数
+        self.consumed = 0 # 回调输出的有效帧数
+        self.reported = 0 # 已推进到播放时钟的帧数
+        self.decoding = 0 # 已提交、还在解码的片段数
+        self.busy = False # 正在连续输出
+        self.clip_starts = deque() # 等待开始播放的片段：(起始帧, 提交时间, 是否在空闲时提交)
+        self.stats = {"clips": 0, "latency_ms": 0.0, "max_latency_ms": 0.0, "underruns": 0, "gap_ms": 0.0} # 输出统计
+        self.sink = sink or make_sink()
+        self.sink.start(self._callback)
+        threading.Thread(target=self._clock_loop, daemon=True).start()
+
+    def play(self, audio: bytes, expected: float = 0.0):
+        # 解码完整的 MP3 片段并排在已有音频之后，expected 为已按帧头登记到播放时钟的时长
+        submitted = self._begin()
+        try:
+            pcm = decode(audio)
+        except Exception:
+            self._end()
+            raise
+        self._write(pcm, submitted, expected)
+
+    def stream(self, data: bytes, expected: float = 0.0):
+        # 写入连续音频流中的一批完整帧，带上前一批最后几帧一起解码
+        submitted = self._begin()
+        try:
+            offsets = list(frame_offsets(data))
+            if not offsets:
+                self._end()
+                return
+            pcm = decode(self.stream_tail + data)
+        except Exception:
+            self._end()
+            raise
+
+        # 前一批的帧只用来补全比特池（缺少比特池的第一帧解码器会丢弃），只保留本批帧对应的 PCM
+        frames = sum(round(samples * OUTPUT_RATE / sample_rate) for _, (_, samples, sample_rate, _) in offsets)
+        pcm = pcm[-frames * FRAME_BYTES:]
+        self.stream_tail = data[offsets[-PRIME_FRAMES][0]:] if len(offsets) >= PRIME_FRAMES else data
+        self._write(pcm, submitted, expected)
+
+    def end_stream(self):
+        # 新的音频流与上一段无关，不再带上之前的帧
+        self.stream_tail = b""
+
+    def _begin(self):
+        # 记录提交时间，解码期间输出的静音计为间隙
+        with self.lock:
+            idle = not self.busy and not self.decoding and self.written == self.consumed
+            self.decoding += 1
+            return time.perf_counter(), idle
+
+    def _end(self):
+        with self.lock:
+            self.decoding -= 1
+
+    def _write(self, pcm: bytes, submitted, expected: float):
+        # 登记片段起点并写入环形缓冲
+        frames = len(pcm) // FRAME_BYTES
+        with self.write_lock:
+            with self.lock:
+                self.clip_starts.append((self.written, *submitted))
+                self.written += frames
+                self.decoding -= 1
+            self.clock.submit(frames / OUTPUT_RATE - expected) # 按实际解码的帧数修正登记的时长
+            self.ring.write(pcm[:frames * FRAME_BYTES])
+
+    def _callback(self, frame_count: int) -> bytes:
+        # 输出回调：从环形缓冲取 PCM，不足时补静音
+        size = frame_count * FRAME_BYTES
+        pcm = self.ring.read(size)
+        frames = len(pcm) // FRAME_BYTES
+        now = time.perf_counter()
+
+        with self.lock:
+            while self.clip_starts and self.clip_starts[0][0] < self.consumed + frames: # 有片段在本次输出中开始播放
+                start, submitted, idle = self.clip_starts.popleft()
+                self.stats["clips"] += 1
+                if idle: # 空闲时提交的片段，记录从提交到发声的延迟
+                    latency_ms = (now - submitted + (start - self.consumed) / OUTPUT_RATE) * 1000
+                    self.stats["latency_ms"] = latency_ms
+                    self.stats["max_latency_ms"] = max(self.stats["max_latency_ms"], latency_ms)
+            self.consumed += frames
+
+            if frames:
+                self.busy = True
+            if frames < frame_count and self.busy:
+                if self.decoding: # 下一个片段已提交但还没写入，产生可听见的间隙
+                    self.stats["underruns"] += 1
+                    self.stats["gap_ms"] += (frame_count - frames) / OUTPUT_RATE * 1000
+                else: # 全部播完
+                    self.busy = False
+
+        return pcm + bytes(size - len(pcm))
+
+    def _clock_loop(self):
+        # 按实际输出的帧数推进播放时钟（不在音频回调中执行订阅者的回调）
+        while True:
+            time.sleep(CLOCK_INTERVAL)
+            with self.lock:
+                frames = self.consumed - self.reported
+                self.reported = self.consumed
+            if frames:
+                self.clock.advance(frames / OUTPUT_RATE)
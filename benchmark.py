@@ -0,0 +1,570 @@
+import os
+import sys
+import time
+import random
+import tempfile
+import shutil
+import atexit
+
+# memory 导入时就会初始化数据库，先指向临时目录，避免迁移或 VACUUM 正在使用的 chat_memory.db
+BENCH_DIR = tempfile.mkdtemp()
+atexit.register(shutil.rmtree, BENCH_DIR, True)
+os.environ["CHAT_MEMORY_DB"] = os.path.join(BENCH_DIR, "chat_memory.db")
+import memory
+
+# 性能测试脚本：python benchmark.py [测试名 ...]
+
+DEFAULT_PRAGMAS = list(memory.PRAGMAS) # memory 默认的连接参数
+
+COMMON_CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研质"
+
+def random_question():
+    # 生成随机问题，模拟直播弹幕
+    return "".join(random.choices(COMMON_CHARS, k=random.randint(4, 16)))
+
+def use_database(path, legacy=False):
+    # 切换 memory 使用的数据库文件；legacy 模拟旧版每次调用新建连接
+    memory.close_connections()
+    memory.DB_PATH = path
+    memory.PRAGMAS = [] if legacy else DEFAULT_PRAGMAS
+    memory.init_db()
+
+def fill_database(rows, users=500):
+    # 批量填充已回答的历史记录
+    conn = memory.get_connection()
+    with conn:
+        for i in range(rows):
+            user_id, question = f"user{i % users}", random_question()
+            cursor = conn.execute(
+                "INSERT INTO chat_records (user_id, event_type, question, response, answered) VALUES (?, ?, ?, ?, ?)",
+                (user_id, "yt_message", question, "回复", True),
+            )
+            memory.index_record(conn, cursor.lastrowid, user_id, "yt_message", question)
+
+def mutate(text):
+    # 随机改动一两个字符，模拟观众重复刷屏
+    chars = list(text)
+    for _ in range(random.randint(1, 2)):
+        chars[random.randrange(len(chars))] = random.choice("啊吗呢!?")
+    return "".join(chars)
+
+def bench_storage(rows_list=(10000, 100000), inserts=500, polls=20):
+    # 对比旧版（每次新建连接）与长连接 + WAL 的插入速度和 get_records 延迟
+    for rows in rows_list:
+        for legacy in (True, False):
+            with tempfile.TemporaryDirectory() as tmp:
+                use_database(os.path.join(tmp, "bench.db"), legacy)
+                fill_database(rows)
+
+                start = time.perf_counter()
+                for i in range(inserts):
+                    memory.save_chat_record(f"bench{i}", "tts_message", random_question())
+                    if legacy:
+                        memory.close_connections() # 旧版每次调用后关闭连接
+                insert_rate = inserts / (time.perf_counter() - start)
+
+                start = time.perf_counter()
+                for _ in range(polls):
+                    memory.get_records()
+                    if legacy:
+                        memory.close_connections()
+                poll_ms = (time.perf_counter() - start) / polls * 1000
+
+                memory.close_connections()
+
+            label = "旧版" if legacy else "WAL"
+            print(f"[storage] rows={rows} {label}: 插入 {insert_rate:.0f} 条/秒, get_records {poll_ms:.1f} ms")
+
+def bench_dedup(rows_list=(10000, 100000), queries=200):
+    # 对比倒排索引与逐条 fuzz.ratio 的召回率和延迟（单个用户发送大量弹幕的最坏情况）
+    from rapidfuzz import fuzz
+
+    for rows in rows_list:
+        with tempfile.TemporaryDirectory() as tmp:
+            use_database(os.path.join(tmp, "bench.db"))
+            fill_database(rows, users=1)
+            conn = memory.get_connection()
+            questions = [rec[0] for rec in conn.execute("SELECT question FROM chat_records LIMIT 1000")]
+            samples = [mutate(random.choice(questions)) if i % 2 else random_question() for i in range(queries)]
+
+            start = time.perf_counter()
+            expected = []
+            for q in samples: # 旧版：读取该用户全部记录后逐条比较
+                records = conn.execute("SELECT id, question FROM chat_records WHERE event_type = ? AND user_id = ?", ("yt_message", "user0")).fetchall()
+                expected.append(any(fuzz.ratio(q, rec[1]) >= 60 for rec in records))
+            brute_ms = (time.perf_counter() - start) / queries * 1000
+
+            start = time.perf_counter()
+            found = [memory.find_similar_record(conn, "user0", "yt_message", q) is not None for q in samples]
+            index_ms = (time.perf_counter() - start) / queries * 1000
+
+            memory.close_connections()
+
+        positives = sum(expected)
+        hits = sum(1 for e, f in zip(expected, found) if e and f)
+        recall = hits / positives if positives else 1.0
+        print(f"[dedup] rows={rows}: 逐条比较 {brute_ms:.2f} ms, 倒排索引 {index_ms:.2f} ms, 召回率 {recall:.1%}")
+
+def bench_scoring(sizes=(1000, 10000, 100000), repeat=5):
+    # 对比逐条 fuzz.ratio 与 process.cdist 批量打分
+    from rapidfuzz import fuzz
+
+    memory.similar_indexes("yt_message", "预热", ["预热"]) # 预先加载 numpy 和线程池
+    for size in sizes:
+        choices = [random_question() for _ in range(size)]
+        question = random_question()
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            [i for i, choice in enumerate(choices) if fuzz.ratio(question, choice) >= 60]
+        loop_ms = (time.perf_counter() - start) / repeat * 1000
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            memory.similar_indexes("yt_message", question, choices)
+        batch_ms = (time.perf_counter() - start) / repeat * 1000
+
+        print(f"[scoring] candidates={size}: 逐条比较 {loop_ms:.2f} ms, 批量打分 {batch_ms:.2f} ms")
+
+def bench_retrieval(rows_list=(100000, 1000000), queries=50):
+    # 对比旧版（读取已回答记录后随机挑选相似问题）与 FTS5 检索的延迟和相关度
+    from rapidfuzz import fuzz
+
+    for rows in rows_list:
+        with tempfile.TemporaryDirectory() as tmp:
+            use_database(os.path.join(tmp, "bench.db"))
+            fill_database(rows)
+            conn = memory.get_connection()
+            questions = [rec[0] for rec in conn.execute("SELECT question FROM chat_records ORDER BY random() LIMIT ?", (queries,))]
+            samples = [mutate(q) for q in questions]
+
+            start = time.perf_counter()
+            legacy_scores = []
+            for q in samples: # 旧版：读取全部已回答记录，随机挑选一条相似度 >= 60 的
+                answered = conn.execute("SELECT question FROM chat_records WHERE answered = 1 AND event_type = ?", ("yt_message",)).fetchall()
+                similar = [rec[0] for rec in answered if fuzz.ratio(q, rec[0]) >= 60]
+                legacy_scores.append(fuzz.ratio(q, random.choice(similar)) if similar else 0)
+            legacy_ms = (time.perf_counter() - start) / queries * 1000
+
+            start = time.perf_counter()
+            results = [memory.search_answers(q, "yt_message") for q in samples]
+            fts_ms = (time.perf_counter() - start) / queries * 1000
+            fts_scores = [fuzz.ratio(q, found[0]["question"]) if found else 0 for q, found in zip(samples, results)]
+
+            memory.close_connections()
+
+        print(f"[retrieval] rows={rows}: 旧版 {legacy_ms:.1f} ms（命中 {sum(1 for x in legacy_scores if x) / queries:.0%}，平均相似度 {sum(legacy_scores) / queries:.0f}）, "
+              f"FTS5 {fts_ms:.2f} ms（命中 {sum(1 for x in fts_scores if x) / queries:.0%}，首条平均相似度 {sum(fts_scores) / queries:.0f}）")
+
+def start_youtube_stub(pages):
+    # 启动本地 HTTP 模拟服务器，按顺序返回录制好的聊天页面，并记录建立的连接数
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    state = {"page": 0, "connections": set()}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # 支持 keep-alive
+        disable_nagle_algorithm = True # 避免 keep-alive 下的延迟确认等待
+
+        def do_GET(self):
+            state["connections"].add(self.client_address)
+            page = pages[state["page"] % len(pages)]
+            state["page"] += 1
+            body = json.dumps(page).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def make_chat_page(size):
+    # 生成一页模拟的 liveChat/messages 响应
+    return {
+        "pollingIntervalMillis": 0,
+        "nextPageToken": str(random.randint(0, 99999)),
+        "items": [
+            {
+                "snippet": {"displayMessage": random_question(), "authorChannelId": f"UC{random.randint(0, 300)}"},
+                "authorDetails": {"displayName": f"viewer{random.randint(0, 300)}"},
+            }
+            for _ in range(size)
+        ],
+    }
+
+def bench_youtube(pages=50, size=200):
+    # 用本地模拟服务器测量每页处理时间，对比每次新建连接与复用 Session
+    import requests
+    import youtube
+
+    youtube.POLL_MIN_INTERVAL = 0
+    server, state = start_youtube_stub([make_chat_page(size) for _ in range(10)])
+    youtube.YOUTUBE_API_URL = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_database(os.path.join(tmp, "bench.db"))
+        for label, http in (("每次新建连接", requests), ("复用 Session", youtube.session)):
+            youtube.session, original = http, youtube.session
+            state["connections"].clear()
+
+            start = time.perf_counter()
+            for _ in range(pages):
+                youtube.poll_live_chat("bench")
+            page_ms = (time.perf_counter() - start) / pages * 1000
+
+            youtube.session = original
+            print(f"[youtube] {label}: 每页 {page_ms:.2f} ms, 建立连接 {len(state['connections'])} 次")
+
+        memory.flush_ingest()
+        memory.close_connections()
+
+    server.shutdown()
+    print(f"[youtube] 发言者缓存：{youtube.author_stats}")
+
+def start_realtime_stub(ack_delay):
+    # 启动本地 Realtime WebSocket 模拟服务器：conversation.item.create 延迟 ack_delay 秒后确认，删除条目立即确认
+    import json
+    import base64
+    import hashlib
+    import struct
+    import threading
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        disable_nagle_algorithm = True # 确认立即发出，不被延迟确认拖慢
+
+        def setup(self):
+            super().setup()
+            self.send_lock = threading.Lock() # 确认由定时器线程发送
+
+        def send(self, event):
+            # 发送一个不带掩码的文本帧
+            data = json.dumps(event).encode()
+            if len(data) < 126:
+                header = struct.pack("!BB", 0x81, len(data))
+            elif len(data) < 65536:
+                header = struct.pack("!BBH", 0x81, 126, len(data))
+            else:
+                header = struct.pack("!BBQ", 0x81, 127, len(data))
+            try:
+                with self.send_lock:
+                    self.wfile.write(header + data)
+            except OSError:
+                pass # 客户端已断开
+
+        def receive(self):
+            # 读取一个客户端帧（客户端的帧都带掩码），返回 (操作码, 数据)，连接关闭时返回 None
+            head = self.rfile.read(2)
+            if len(head) < 2 or head[0] & 0x0F == 0x08:
+                return None
+            length = head[1] & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self.rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self.rfile.read(8))[0]
+            mask = self.rfile.read(4)
+            payload = self.rfile.read(length)
+            return head[0] & 0x0F, bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+        def handle(self):
+            # 完成 WebSocket 握手后按事件类型回复
+            headers = {}
+            self.rfile.readline() # 请求行
+            while True:
+                line = self.rfile.readline().decode().strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            key = headers["sec-websocket-key"] + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+            accept = base64.b64encode(hashlib.sha1(key.encode()).digest()).decode()
+            self.wfile.write(
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n".encode()
+            )
+
+            while True:
+                frame = self.receive()
+                if frame is None:
+                    break
+                opcode, payload = frame
+                if opcode != 0x01: # 只处理文本帧
+                    continue
+                event = json.loads(payload)
+                if event["type"] == "conversation.item.create":
+                    created = {"type": "conversation.item.created", "item": event["item"]}
+                    threading.Timer(ack_delay, self.send, (created,)).start()
+                elif event["type"] == "conversation.item.delete":
+                    self.send({"type": "conversation.item.deleted", "item_id": event["item_id"]})
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_submit(item_counts=(3, 8, 15), ack_delay=0.02, repeat=10):
+    # 用本地模拟服务器测量一轮上下文条目从发送到全部确认的耗时，对比旧版每条之间固定等待 0.2 秒
+    import types
+
+    server = start_realtime_stub(ack_delay)
+    os.environ["OPENAI_WS_URL"] = f"ws://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    # chat 导入时启动的 YouTube 爬虫和 ElevenLabs 预热连接都指向无人监听的本地端口，不访问真实服务
+    os.environ["YOUTUBE_API_URL"] = "http://127.0.0.1:9"
+    os.environ["ELEVENLABS_WS_URL"] = "ws://127.0.0.1:9"
+    # vts 导入时连接 VTube Studio，word 打开字幕窗口，测试只需要对话链路，用空实现代替
+    sys.modules.setdefault("vts", types.SimpleNamespace(send_host_key=lambda hostkey: None))
+    sys.modules.setdefault("word", types.SimpleNamespace(add_text=lambda text: None))
+    import chat
+
+    if not chat.session_ready.wait(5):
+        print("[submit] 无法连接模拟服务器")
+        server.shutdown()
+        return
+
+    for count in item_counts:
+        chains = []
+        for _ in range(repeat):
+            items, previous_item_id = [], "msg_001"
+            for _ in range(count):
+                item_id = chat.generate_id()
+                items.append({
+                    "type": "conversation.item.create",
+                    "previous_item_id": previous_item_id,
+                    "item": {"id": item_id, "type": "message", "role": "user", "content": [{"type": "input_text", "text": "bench：测试问题"}]},
+                })
+                previous_item_id = item_id
+
+            if chat.send_message(items, True, False):
+                chains.append(chat.submit_stats["last_chain_ms"])
+            chat.finish_turn() # 删除本轮条目，复用同一个连接
+            chat.session_ready.wait(5)
+
+        if not chains:
+            print(f"[submit] {count} 条：全部发送失败 {chat.submit_stats}")
+            continue
+        print(f"[submit] {count} 条，确认延迟 {ack_delay * 1000:.0f} ms：旧版逐条等待 {count * 200:.0f} ms, "
+              f"连续发送后等待确认 平均 {sum(chains) / len(chains):.1f} ms, 最长 {max(chains):.1f} ms")
+
+    server.shutdown()
+
+def bench_emotion(path=None):
+    # 本地情绪检测与录制的远程工具结果的一致率、需要远程判断的比例和延迟
+    # 标注来自直播时设置 EMOTION_LABEL_LOG 录制的 JSONL 文件（远程调用需额外一次网络往返，无法离线测量）
+    import emotion
+
+    path = path or emotion.EMOTION_LABEL_LOG
+    if not path or not os.path.exists(path):
+        print("[emotion] 没有录制的远程标注，设置 EMOTION_LABEL_LOG 直播一段时间后再测试")
+        return
+    samples = emotion.load_labels(path)
+    if not samples:
+        print(f"[emotion] {path} 中没有标注")
+        return
+
+    for backend in emotion.BACKENDS:
+        if backend == "model" and not emotion.EMOTION_MODEL:
+            continue # 未配置模型
+        emotion.EMOTION_BACKEND = backend
+
+        agreed = confident = confident_agreed = 0
+        start = time.perf_counter()
+        for text, label in samples:
+            stream = emotion.EmotionStream()
+            for i in range(0, len(text), 3): # 模拟流式增量
+                stream.feed(text[i:i + 3])
+            detected, _ = stream.finish()
+            agreed += (detected or "无") == label # 关闭远程回退时得分过低按“无”处理
+            if detected is not None:
+                confident += 1
+                confident_agreed += detected == label
+        per_reply_ms = (time.perf_counter() - start) / len(samples) * 1000
+
+        print(f"[emotion] {backend}: {len(samples)} 条标注，与远程结果一致 {agreed / len(samples):.0%}，"
+              f"本地可判断 {confident / len(samples):.0%}（其中一致 {confident_agreed / max(confident, 1):.0%}），"
+              f"开启远程回退时需远程调用 {1 - confident / len(samples):.0%}，每条回复 {per_reply_ms:.3f} ms")
+
+def record_deltas(replies=200):
+    # 模拟录制的 response.text.delta 流：每条回复按 1~4 字切分
+    sentences = ["哼，你才知道吗？", "今天的直播好开心😀！", "Hello everyone, welcome back!", "I am 3.5 years old. Bye. ", "下次再一起玩吧～", "这个问题嘛……我想想。"]
+    streams = []
+    for _ in range(replies):
+        text = "".join(random.choices(sentences, k=6))
+        deltas, i = [], 0
+        while i < len(text):
+            step = random.randint(1, 4)
+            deltas.append(text[i:i + step])
+            i += step
+        streams.append(deltas)
+    return streams
+
+def bench_normalize(replies=200):
+    # 对比旧版（每个增量编译两次 emoji 正则）与流式规范化的吞吐量
+    import regex
+    import normalize
+
+    streams = record_deltas(replies)
+    total = sum(len(deltas) for deltas in streams)
+
+    def legacy_remove_emoji(text):
+        emoji_pattern = regex.compile(r'\p{Emoji}', flags=regex.UNICODE)
+        return emoji_pattern.sub('', text).strip()
+
+    start = time.perf_counter()
+    for deltas in streams:
+        buffer, received = [], ""
+        for delta in deltas:
+            buffer.append(legacy_remove_emoji(delta))
+            received += legacy_remove_emoji(delta)
+    legacy_rate = total / (time.perf_counter() - start)
+
+    segments = []
+    stream = normalize.TextStream()
+    stream.subscribe(lambda text, kind: segments.append(text))
+    start = time.perf_counter()
+    for deltas in streams:
+        for delta in deltas:
+            stream.feed(delta)
+        stream.finish()
+    stream_rate = total / (time.perf_counter() - start)
+
+    print(f"[normalize] 旧版 {legacy_rate:.0f} 增量/秒, 流式规范化 {stream_rate:.0f} 增量/秒（输出 {len(segments)} 个分句）")
+
+    # 英文句点：后跟空白或回复结束时断句，小数不断句
+    text = "Hello everyone. Welcome back. I am 3.5 years old. Bye."
+    segments.clear()
+    for i in range(0, len(text), 3):
+        stream.feed(text[i:i + 3])
+    stream.finish()
+    print(f"[normalize] 英文断句：{segments}")
+
+def load_tts_corpus(path=None, clips=200):
+    # 读取录制的 ElevenLabs 音频（目录下的 .mp3 文件），没有时生成 44.1kHz/128kbps 单声道的静音帧
+    path = path or os.getenv("TTS_CORPUS")
+    if path:
+        corpus = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".mp3"):
+                with open(os.path.join(path, name), "rb") as f:
+                    corpus.append(f.read())
+        return corpus
+
+    frame_length = 144 * 128000 // 44100
+    header = bytes([0xFF, 0xFB, 0x90, 0xC4])
+    return [b"".join(header + bytes(frame_length - 4) for _ in range(random.randint(20, 150))) for _ in range(clips)]
+
+def bench_mp3(path=None, clips=200):
+    # 对比旧版（临时文件 + pydub 完整解码）与内存中解析帧头获取时长的每段开销
+    import mp3
+
+    corpus = load_tts_corpus(path, clips)
+    start = time.perf_counter()
+    durations = [mp3.mp3_duration(audio) for audio in corpus]
+    probe_ms = (time.perf_counter() - start) / len(corpus) * 1000
+
+    try:
+        from pydub import AudioSegment
+    except ImportError:
+        AudioSegment = None # 未安装 pydub 时只测量旧版的文件读写部分
+
+    errors = []
+    start = time.perf_counter()
+    for audio, duration in zip(corpus, durations):
+        fd, temp_audio_path = tempfile.mkstemp(suffix=".mp3")
+        os.close(fd)
+        with open(temp_audio_path, "wb") as temp_mp3:
+            temp_mp3.write(audio)
+        if AudioSegment and path:
+            errors.append(abs(len(AudioSegment.from_file(temp_audio_path, format="mp3")) / 1000 - duration))
+        with open(temp_audio_path, "rb") as temp_mp3:
+            temp_mp3.read()
+        os.remove(temp_audio_path)
+    legacy_ms = (time.perf_counter() - start) / len(corpus) * 1000 + 200 # 旧版每段还固定等待 2 次 0.1 秒
+
+    legacy = "含 pydub 解码" if AudioSegment and path else "不含解码"
+    print(f"[mp3] {len(corpus)} 段, 平均 {sum(durations) / len(durations):.2f} 秒/段; 旧版 {legacy_ms:.1f} ms/段（{legacy}）, 帧头解析 {probe_ms:.3f} ms/段")
+    if errors:
+        print(f"[mp3] 与 pydub 解码时长的最大误差 {max(errors) * 1000:.1f} ms")
+
+def bench_stream(streams=20, interval=0.05):
+    # 回放切分后的 TTS 音频块，测量流式播放的首音延迟和欠载次数（播放命令替换为 cat，输出丢弃）
+    import play
+
+    play.AUDIO_BACKEND = "ffplay"
+    play.STREAM_ARGS = ["cat"]
+    play.AudioPlayer.is_installed = lambda self, lib_name: True
+    player = play.AudioPlayer()
+
+    legacy = []
+    for audio in load_tts_corpus(clips=streams):
+        start, pos = time.perf_counter(), 0
+        while pos < len(audio): # ElevenLabs 的音频块大小不按帧对齐
+            step = random.randint(2000, 8000)
+            player.feed(audio[pos:pos + step])
+            pos += step
+            time.sleep(interval)
+        legacy.append(time.perf_counter() - start + 1) # 旧版等全部音频到达后再等 1 秒静默才开始播放
+        player.end_stream()
+        time.sleep(0.1)
+
+    stats = player.stream_stats
+    legacy_ms = sum(legacy) / len(legacy) * 1000
+    print(f"[stream] {stats['streams']} 段, 首音延迟 {stats['first_audio_ms']:.1f} ms（最大 {stats['max_first_audio_ms']:.1f} ms）, 欠载 {stats['underruns']} 次; 旧版平均首音延迟 {legacy_ms:.0f} ms")
+
+def bench_output(clips=8, lead=0.2):
+    # 进程内输出引擎（无声卡输出）的首音延迟和片段间隙，对比每段启动一次 ffplay 的额外耗时
+    import subprocess
+    import audio_engine
+    import play
+    from mp3 import mp3_duration
+
+    corpus = load_tts_corpus(clips=clips)
+    if audio_engine.miniaudio is None:
+        print("[output] 未安装 miniaudio，跳过进程内引擎")
+    else:
+        clock = play.PlaybackClock()
+        engine = audio_engine.OutputEngine(clock, audio_engine.NullSink())
+        for audio in corpus: # 上一段剩余不到 lead 秒时提交下一段，模拟 TTS 逐段到达
+            while clock.remaining() > lead:
+                time.sleep(0.005)
+            engine.play(audio)
+        clock.finished.wait()
+        stats = engine.stats
+        print(f"[output] 进程内引擎 {stats['clips']} 段: 首音延迟 {stats['latency_ms']:.1f} ms, 间隙 {stats['gap_ms']:.1f} ms（欠载 {stats['underruns']} 次）")
+
+    if not shutil.which("ffplay"):
+        print("[output] 未安装 ffplay，跳过对比")
+        return
+    overhead = []
+    for audio in corpus[:3]:
+        start = time.perf_counter()
+        subprocess.run(["ffplay", "-autoexit", "-nodisp", "-"], input=audio, capture_output=True, env={**os.environ, "SDL_AUDIODRIVER": "dummy"})
+        overhead.append(time.perf_counter() - start - mp3_duration(audio))
+    print(f"[output] ffplay 每段额外耗时（启动、初始化解码器和设备）平均 {sum(overhead) / len(overhead) * 1000:.0f} ms")
+
+BENCHMARKS = {
+    "storage": bench_storage,
+    "dedup": bench_dedup,
+    "scoring": bench_scoring,
+    "retrieval": bench_retrieval,
+    "youtube": bench_youtube,
+    "submit": bench_submit,
+    "emotion": bench_emotion,
+    "normalize": bench_normalize,
+    "mp3": bench_mp3,
+    "stream": bench_stream,
+    "output": bench_output,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -1,37 +1,68 @@
 import json
 import os
-import requests
 import websocket
 import threading
 import time
+import queue
 from dotenv import load_dotenv 
-from status import update_status, processing
+from status import update_status, processing, notify_work
 from vts import send_host_key
-from tts import add_buffer
-import regex
+from tts import add_buffer, end_reply
 import memory
+import youtube
+import context
+from emotion import EmotionStream, EMOTION_LABEL_LOG, record_label
+from normalize import TextStream
 
 load_dotenv()  # 加载 .env 文件
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") # OpenAI API 密钥
-YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY") # YouTube API 密钥
 
 # Openai WebSocket URL & 头部信息
-OPENAI_WS_URL = "wss://api.openai.com/v1/realtime?model=gpt-4o-mini-realtime-preview-2024-12-17"
+OPENAI_WS_URL = os.getenv("OPENAI_WS_URL", "wss://api.openai.com/v1/realtime?model=gpt-4o-mini-realtime-preview-2024-12-17") # 可指向本地模拟服务器
 HEADERS = [
     "Authorization: Bearer " + OPENAI_API_KEY,
     "OpenAI-Beta: realtime=v1"
 ]
 
-live_chat_id = "" # Youtube 直播视频 ID
-next_page_token = None # 下一页令牌
 id_list = [] # 保存历史记录使用
 global_id_list = [] # 不包括 "msg_001"，从 "msg_002" 开始生成 ID
 received_text = "" # 存储接收到的全部字体
+current_question = "" # 本轮回答的问题，用于记录对话历史
+turn_active = False # 对话中是否有正在生成的回合
 
 # 全局 WebSocket 连接 & 线程锁
 ws_global = None
 lock = threading.Lock()
 
+character_setup = None # 缓存的角色人设，只读取一次文件
+conversation_items = [] # 服务器对话中除人设外的所有条目 ID，每轮结束后删除
+pending_deletes = set() # 等待服务器确认删除的条目 ID
+session_ready = threading.Event() # 对话已重置，可以开始下一轮
+reset_started = 0 # 开始重置对话的时间
+session_stats = {"resets": 0, "reconnects": 0, "last_ready_ms": 0.0, "total_ready_ms": 0.0} # 下一轮就绪耗时统计
+
+text_stream = TextStream() # 流式文本规范化和分句
+emotion_stream = EmotionStream() # 本地流式情绪检测
+EMOTION_REMOTE_FALLBACK = True # 本地得分过低时请求远程工具；关闭时按“无”处理，每轮少一次往返，但情绪不明显的回复不会触发表情
+remote_emotion = False # 本轮是否由远程工具的结果触发表情
+awaiting_emotion = False # 回复文本已结束，正在等待远程情绪检测
+
+BATCH_SIZE = None # 每轮回答的问题组数，None 按积压自动调整（上限见 memory.MAX_BATCH_SIZE），1 为逐条回答
+BATCH_PROMPT = "以下是多位观众的弹幕，请在一条回复中依次简短回应每一位：\n" # 合并回答的提示
+
+PREFETCH_MODE = False # 播放当前回复时预生成下一条回复
+PREFETCH_MAX_AGE = 60 # 预生成的回复超过该时间（秒）未播放则丢弃
+lookahead = queue.Queue(maxsize=1) # 预生成回复队列
+prefetching = False # 当前生成的回复是否为预生成
+prefetch_segments = [] # 预生成回复的分句和类型，播放时再交给 TTS
+prefetch_stats = {"prefetched": 0, "released": 0, "stale": 0} # 预生成统计
+
+ACK_TIMEOUT = 5 # 等待条目创建确认的最长时间（秒）
+ack_condition = threading.Condition() # 条目创建确认的通知
+pending_acks = set() # 已发送但未确认的条目 ID
+ack_error = None # 等待确认期间服务器返回的错误
+submit_stats = {"last_chain_ms": 0.0, "timeouts": 0, "errors": 0} # 从发送条目到全部确认的耗时统计
+
 emotion_event = {
     "type": "response.create",
     "response": {
@@ -79,12 +110,23 @@ def connect_ws():
     except Exception as e:
         update_status(f"OpenAI WebSocket 连接失败：{e}")
 
+def load_character_setup():
+    # 读取角色人设，之后直接使用缓存
+    global character_setup
+    if character_setup is None:
+        with open("character_setup.txt", "r", encoding="utf-8") as f:
+            character_setup = f.read()
+    return character_setup
+
 def on_open(ws):
     # 连接成功时触发 
-    with open("character_setup.txt", "r", encoding="utf-8") as f:
-        content = f.read() 
+    global turn_active, prefetching
+    turn_active = prefetching = False # 断线前未完成的回合作废
+    conversation_items.clear() # 新连接的对话是空的
+    pending_deletes.clear()
+    session_stats["reconnects"] += 1
 
-    character_setup = [{ 
+    setup_message = [{ 
         "type": "conversation.item.create",
         "previous_item_id": None,
         "item": {
@@ -94,22 +136,48 @@ def on_open(ws):
             "content": [
                 {
                     "type": "input_text",
-                    "text": content # 添加角色人设
+                    "text": load_character_setup() # 添加角色人设
                 }
             ]
         }
     }]
     
-    send_message(character_setup, False, False) # 只发送一次角色人设
+    send_message(setup_message, False, False) # 每个连接只发送一次角色人设
+    session_ready.set()
+    notify_work()
+
+def reset_conversation():
+    # 删除本轮的对话条目，保留角色人设，复用同一个连接开始下一轮
+    global reset_started
+    session_ready.clear()
+    reset_started = time.perf_counter()
 
-def remove_emoji(text):
-    # 去除 emoji 并去掉空格
-    emoji_pattern = regex.compile(r'\p{Emoji}', flags=regex.UNICODE)
-    return emoji_pattern.sub('', text).strip() 
+    with lock:
+        pending_deletes.update(conversation_items)
+        try:
+            for item_id in conversation_items:
+                ws_global.send(json.dumps({"type": "conversation.item.delete", "item_id": item_id}))
+        except Exception as e:
+            update_status(f"重置 OpenAI 对话失败：{e}")
+            ws_global.close() # 无法删除时重新连接
+            return
+        conversation_items.clear()
+
+    if not pending_deletes:
+        mark_session_ready()
+
+def mark_session_ready():
+    # 对话重置完成，记录下一轮就绪耗时
+    elapsed_ms = (time.perf_counter() - reset_started) * 1000
+    session_stats["resets"] += 1
+    session_stats["last_ready_ms"] = elapsed_ms
+    session_stats["total_ready_ms"] += elapsed_ms
+    session_ready.set()
+    notify_work() # 对话可用，唤醒调度
 
 def on_message(ws, message):
     # 处理从 OpenAI WebSocket 收到的数据
-    global received_text, last_update_time, id_list, global_id_list, emotion_event
+    global received_text, last_update_time, id_list, global_id_list, emotion_event, ack_error, remote_emotion, awaiting_emotion, prefetching
 
     data = json.loads(message)  # 解析收到的消息
     event_type = data.get("type") # 获取消息类型
@@ -117,11 +185,19 @@ def on_message(ws, message):
     if event_type in ["response.text.delta", "response.function_call_arguments.delta"]:
         delta = data.get("delta", "")  # 获取文本
         if event_type == "response.text.delta":
-            add_buffer(remove_emoji(delta))
+            delta = text_stream.feed(delta) # 去除 emoji，完整分句会推送给 TTS
+            emotion = emotion_stream.feed(delta) # 本地检测情绪，达到阈值立即触发表情
+            if emotion and not prefetching: # 预生成的回复等播放时再触发表情
+                send_host_key(emotion)
 
-        received_text += remove_emoji(delta)
+        received_text += delta
+
+    elif event_type == "response.text.done" and prefetching:
+        store_prefetched(text_stream.finish()) # 预生成的回复放入队列，等待当前播放结束
 
     elif event_type == "response.text.done":
+        received_text = text_stream.finish() # 推送剩余文本
+        end_reply() # 本轮文本结束，剩余语音播完后回合才结束
         emotion_event["response"]["input"].append({
             "type": "message",
             "role": "assistant",
@@ -131,24 +207,135 @@ def on_message(ws, message):
             }]
         })
         
-        for id in id_list:
+        for id in id_list: # 合并回答时每组一个 ID，同组的问题一并标记
             memory.update_chat_response(id, received_text) 
-            id_list.clear() # 清空所有以保存纪录的 ID
+        id_list.clear() # 清空所有以保存纪录的 ID
+
+        context.add_exchange(current_question, received_text) # 加入对话历史，旧对话折叠进摘要
 
         received_text = ""
-        send_message([], False, True)
+        emotion, fired = emotion_stream.finish()
+        emotion_stream.reset()
+        if emotion and not fired:
+            send_host_key(emotion) # 触发表情
+
+        remote_emotion = emotion is None and EMOTION_REMOTE_FALLBACK # 本地无法判断，使用远程工具检测情绪
+        if remote_emotion or EMOTION_LABEL_LOG: # 记录标注时每条回复都请求远程结果
+            awaiting_emotion = True
+            send_message([], False, True)
+        else:
+            finish_turn()
 
     elif event_type == "response.function_call_arguments.done":
         received_text = json.loads(received_text)
-        send_host_key(next(iter(received_text))) # 触发表情
+        label = next(iter(received_text), "无")
+        if EMOTION_LABEL_LOG:
+            record_label(emotion_event["response"]["input"][-1]["content"][0]["text"], label) # 最后一条输入是本轮回复
+        if remote_emotion:
+            send_host_key(label) # 触发表情
+        finish_turn()
+
+    elif event_type == "conversation.item.created":
+        item_id = data.get("item", {}).get("id")
+        with ack_condition:
+            pending_acks.discard(item_id)
+            ack_condition.notify_all()
+
+        if item_id and item_id != "msg_001":
+            conversation_items.append(item_id) # 记录需要在本轮结束后删除的条目
+
+    elif event_type == "conversation.item.deleted":
+        pending_deletes.discard(data.get("item_id"))
+        if not pending_deletes and not session_ready.is_set():
+            mark_session_ready()
+
+    elif event_type == "error":
+        update_status(f"OpenAI 返回错误：{data.get('error', {}).get('message')}")
+        with ack_condition:
+            waiting_acks = bool(pending_acks)
+            if waiting_acks: # 正在等待条目确认，通知发送方放弃本轮
+                ack_error = data.get("error", {}).get("message")
+                ack_condition.notify_all()
+
+        if pending_deletes: # 删除条目失败时重新连接，保证下一轮可以开始
+            pending_deletes.clear()
+            ws_global.close()
+        elif turn_active and not waiting_acks: # 回复生成失败（限流、已有回复在生成等），结束本轮，否则调度会一直等待
+            if prefetching:
+                prefetching = False
+                prefetch_segments.clear()
+                text_stream.reset()
+            elif not awaiting_emotion: # 推送已收到的文本，TTS 播完后取消处理状态
+                text_stream.finish()
+                end_reply()
+            emotion_stream.reset()
+            finish_turn()
+
+def route_segment(text, kind):
+    # 分句事件：正常回合直接交给 TTS，预生成回合先暂存
+    if prefetching:
+        prefetch_segments.append((text, kind))
+    else:
+        add_buffer(text, kind)
+
+def store_prefetched(text):
+    # 保存预生成的回复，之后由 release_prefetched 播放
+    global prefetching
+    emotion, _ = emotion_stream.finish()
+    emotion_stream.reset()
+
+    lookahead.put({
+        "ids": list(id_list),
+        "question": current_question,
+        "text": text,
+        "segments": list(prefetch_segments),
+        "emotion": emotion,
+        "created": time.time(),
+    })
+    prefetch_segments.clear()
+    prefetching = False
+    prefetch_stats["prefetched"] += 1
+    finish_turn()
+
+def release_prefetched():
+    # 当前播放结束后播放预生成的回复，过期的直接丢弃，返回是否已开始播放
+    while True:
+        try:
+            item = lookahead.get_nowait()
+        except queue.Empty:
+            return False
+
+        still_pending = memory.pending_ids(item["ids"])
+        if not still_pending or time.time() - item["created"] > PREFETCH_MAX_AGE: # 已被回答或等待太久
+            prefetch_stats["stale"] += 1
+            continue
+
+        processing(True) # 开启处理状态
+        for text, kind in item["segments"]:
+            add_buffer(text, kind)
+        end_reply()
+        if item["emotion"]:
+            send_host_key(item["emotion"]) # 触发表情
+
+        for record_id in still_pending: # 同一聚类一并标记为已回答
+            memory.update_chat_response(record_id, item["text"])
+        context.add_exchange(item["question"], item["text"])
+        update_status(f"ChatGpt：{item['text']}")
+        prefetch_stats["released"] += 1
+        return True
+
+def finish_turn():
+    # 本轮结束，清空上下文并重置对话
+    global received_text, turn_active, awaiting_emotion
+    turn_active = awaiting_emotion = False
+    emotion_event["response"]["input"] = []
+    received_text = ""  
+    global_id_list.clear()
+    reset_conversation() # 清空对话，保持连接
 
-        ws_global.close() # 断开连接
-        emotion_event["response"]["input"] = []
-        received_text = ""  
-        global_id_list.clear()
-            
 def on_close(ws, close_status_code, close_msg):
     # WebSocket 断开时触发 
+    session_ready.clear()
     #update_status(f"OpenAI WebSocket 关闭信息：{close_status_code}, {close_msg}")
     connect_ws() # 尝试重新连接
 
@@ -156,68 +343,6 @@ def on_error(ws, error):
     # WebSocket 发生错误 
     update_status(f"OpenAI WebSocket 错误：{error}")
 
-def get_live_chat_id():
-    # 获取 Live Chat ID
-    try:
-        url = f"https://www.googleapis.com/youtube/v3/videos?id={live_chat_id}&part=liveStreamingDetails&key={YOUTUBE_API_KEY}"
-        response = requests.get(url).json()
-        return response.get("items", [{}])[0].get("liveStreamingDetails", {}).get("activeLiveChatId", None)
-    
-    except Exception as e:
-        update_status(f"获取 Youtube Live Chat ID 失败：{e}")
-        return None
-
-def get_channel_info(channel_id):
-    # 获取频道信息
-    try:
-        url = f"https://www.googleapis.com/youtube/v3/channels?part=snippet&id={channel_id}&key={YOUTUBE_API_KEY}"
-        response = requests.get(url)
-
-        if response.status_code != 200:
-            print(f"获取 Youtube 频道信息失败：{response.json()}")
-            return None
-
-        data = response.json()
-        items = data.get("items", [])
-
-        return items[0]["snippet"]["title"]  # 返回频道的显示名称
-    
-    except Exception as e:
-        update_status(f"获取 Youtube 频道信息失败: {e}")
-        return None
-    
-def crawl_youtube_messages():
-    # 爬取 YouTube 聊天消息
-    global next_page_token
-    live_chat_id = get_live_chat_id()
-
-    if live_chat_id:
-        while True:
-            try:
-                chat_url = f"https://www.googleapis.com/youtube/v3/liveChat/messages?liveChatId={live_chat_id}&part=snippet&key={YOUTUBE_API_KEY}"
-                if next_page_token:
-                    chat_url += f"&pageToken={next_page_token}" # 添加分页令牌
-
-                response = requests.get(chat_url)
-                if response.status_code != 200:
-                    update_status(f"获取 Youtube 消息失败：{response.status_code}")
-                    continue
-
-                chat_messages = response.json()
-
-                for message in chat_messages.get('items', []): # 遍历消息列表
-                    display_message = message['snippet']['displayMessage'] # 获取显示消息
-                    author_channel_id = message["snippet"].get("authorChannelId", "Unknown Author")  # Channel ID
-                    display_name = get_channel_info(author_channel_id)  # 获取发言者的显示名称
-                    memory.save_chat_record(display_name, "yt_message", display_message) # 添加消息记录
-   
-                next_page_token = chat_messages.get('nextPageToken') # 获取下一页的令牌
-
-            except Exception as e:
-                update_status(f"爬取 YouTube 消息失败：{e}")
-
-            time.sleep(1)
-
 def generate_id():
     # 从 "msg_002" 开始递增生成 ID
     new_id = f"msg_{len(global_id_list) + 2:03}"  
@@ -226,56 +351,94 @@ def generate_id():
 
 def process_pending_questions():
     # 处理和生成 OpenAI WebSocket 支持的聊天内容
-    global id_list
-    records_list, id_list = memory.get_records()
+    global id_list, current_question, prefetching, turn_active
+    if not session_ready.is_set() or turn_active: # 上一轮的对话还在生成或重置
+        return
+
+    if processing(): # 正在播放时预生成下一条回复
+        if not PREFETCH_MODE or lookahead.full():
+            return
+        prefetch = True
+    elif release_prefetched():
+        return
+    else:
+        prefetch = False
+
+    # 排除已经预生成、等待播放的问题
+    in_flight = [record_id for item in list(lookahead.queue) for record_id in item["ids"]]
+    records_list, id_list = memory.get_records(exclude_ids=in_flight, batch_size=BATCH_SIZE)
     messages = []
     
     if records_list:  # 如果有待处理记录
+        pending = [rec for rec in records_list if not rec["answered"]]
+        questions = [f"{rec['user_id']}：{rec['question']}" for rec in pending]
+        if len(questions) > 1: # 合并回答多位观众的问题
+            current_question = BATCH_PROMPT + "\n".join(questions)
+        else:
+            current_question = questions[0]
+        references = [(f"{rec['user_id']}：{rec['question']}", rec["response"]) for rec in records_list if rec["answered"]]
+
         previous_item_id = "msg_001"  # 第一个记录的 previous_item_id 始终是 msg_001
-        for rec in reversed(records_list):
-            user_id = generate_id()  # 为每个信息生成新 ID
+        for role, text in context.build_context(current_question, references): # 按 token 预算组合上下文
+            item_id = generate_id()  # 为每个信息生成新 ID
 
             messages.append({
                 "type": "conversation.item.create",
                 "previous_item_id": previous_item_id,
                 "item": {
-                    "id": user_id,
+                    "id": item_id,
                     "type": "message",
-                    "role": "user",
+                    "role": role,
                     "content": [{
-                        "type": "input_text",
-                        "text": f"{rec["user_id"]}：{rec["question"]}"
+                        "type": "text" if role == "assistant" else "input_text",
+                        "text": text
                     }]
                 }
             })
-
-            if rec.get("answered", False):
-                assistant_id = generate_id()  # 为每个助手生成新 ID
-                messages.append({
-                    "type": "conversation.item.create",
-                    "previous_item_id": user_id,
-                    "item": {
-                        "id": assistant_id,
-                        "type": "message",
-                        "role": "assistant",
-                        "content": [{
-                            "type": "text",
-                            "text": rec["response"]
-                        }]
-                    }
-                })
-
-                previous_item_id = assistant_id  # 更新 previous_item_id 为刚刚生成的 assistant_id
+            previous_item_id = item_id  # 下一个条目接在当前条目之后
         
-        send_message(messages, True, False)
-        processing(True) # 开启处理状态
+        prefetching = prefetch
+        turn_active = True
+        if send_message(messages, True, False):
+            if prefetch:
+                update_status("正在预生成下一条回复...")
+            else:
+                processing(True) # 开启处理状态
+        else:
+            prefetching = False
+            turn_active = False
+            global_id_list.clear()
+            emotion_event["response"]["input"] = []
+            reset_conversation() # 发送失败，清除已创建的条目，下次重新处理
+
+def wait_for_acks():
+    # 等待服务器确认所有条目已创建，返回是否成功
+    with ack_condition:
+        finished = ack_condition.wait_for(lambda: not pending_acks or ack_error, timeout=ACK_TIMEOUT)
+        if ack_error:
+            update_status(f"OpenAI 创建对话条目失败：{ack_error}")
+            submit_stats["errors"] += 1
+            return False
+        if not finished:
+            update_status(f"等待 OpenAI 确认对话条目超时：{sorted(pending_acks)}")
+            submit_stats["timeouts"] += 1
+            return False
+    return True
 
 def send_message(prompt_payload, generate_response, emotion_detect):
-    # 通过 WebSocket 发送消息给 ChatGPT 
-    global emotion_event
+    # 通过 WebSocket 发送消息给 ChatGPT，返回是否发送成功
+    global emotion_event, ack_error
+    start = time.perf_counter()
+
     with lock:
         try:
-            for item in prompt_payload:
+            if generate_response: # 记录需要确认的条目
+                with ack_condition:
+                    pending_acks.clear()
+                    pending_acks.update(item["item"]["id"] for item in prompt_payload)
+                    ack_error = None
+
+            for item in prompt_payload: # 连续发送所有条目，不等待确认
                 ws_global.send(json.dumps(item)) 
 
                 if item["item"]["id"] != "msg_001":
@@ -290,26 +453,38 @@ def send_message(prompt_payload, generate_response, emotion_detect):
                         content_text = f"ChatGpt：{content_text}"
 
                     update_status(content_text)
-                    
-                time.sleep(0.2)  
-
-            if generate_response: # 触发 AI 生成回复
-                generate_event = {
-                    "type": "response.create",
-                    "response": {
-                            "modalities": ["text"], 
-                            "instructions": "根据上下文推理生成精简回复",
-                            "temperature": 1.0,
-                            "conversation": None
-                        }
-                    }
-                ws_global.send(json.dumps(generate_event))
-            
+
             if emotion_detect: # 对当前上下文进行情绪检测
                 ws_global.send(json.dumps(emotion_event))
              
         except Exception as e:
             update_status(f"发送 OpenAI WebSocket 请求失败：{e}")
+            return False
+
+    if generate_response: # 所有条目确认后触发 AI 生成回复
+        if not wait_for_acks():
+            return False
+
+        submit_stats["last_chain_ms"] = (time.perf_counter() - start) * 1000
+        generate_event = {
+            "type": "response.create",
+            "response": {
+                    "modalities": ["text"], 
+                    "instructions": "根据上下文推理生成精简回复",
+                    "temperature": 1.0,
+                    "conversation": None
+                }
+            }
+
+        with lock:
+            try:
+                ws_global.send(json.dumps(generate_event))
+            except Exception as e:
+                update_status(f"发送 OpenAI WebSocket 请求失败：{e}")
+                return False
+
+    return True
 
+text_stream.subscribe(route_segment) # TTS 按分句接收文本
 connect_ws()
-threading.Thread(target=crawl_youtube_messages, daemon=True).start() 
\ No newline at end of file
+threading.Thread(target=youtube.crawl_youtube_messages, daemon=True).start() 
\ No newline at end of file
@@ -0,0 +1,96 @@
+import regex
+from collections import deque
+
+CONTEXT_TOKEN_BUDGET = 1500 # 每轮发送给模型的上下文上限（估算 token）
+HISTORY_TOKEN_BUDGET = 600 # 保留原文的最近对话上限，超出部分折叠进摘要
+SUMMARY_TOKEN_BUDGET = 300 # 滚动摘要上限，超出时丢弃最旧的摘要行
+SUMMARY_ANSWER_CHARS = 30 # 摘要中每条回复保留的字数
+
+CJK_PATTERN = regex.compile(r"[\p{Han}\p{Hiragana}\p{Katakana}\p{Hangul}]") # 中日韩字符约 1 字 1 token
+
+history = deque() # 最近的对话 (问题, 回复, token 数)
+history_tokens = 0 # 最近对话的 token 总数
+summary_lines = deque() # 滚动摘要，每行 (文本, token 数)
+summary_tokens = 0 # 摘要的 token 总数
+context_stats = { # 每轮上下文大小统计
+    "last_prompt_tokens": 0,
+    "max_prompt_tokens": 0,
+    "last_items": 0,
+    "summary_tokens": 0,
+    "history_turns": 0,
+    "dropped_references": 0,
+}
+
+def estimate_tokens(text):
+    # 估算 token 数：中日韩字符每字 1 个，其他字符约 4 个 1 个
+    text = text or ""
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def fold_into_summary(question, answer):
+    # 把一轮旧对话压缩成一行摘要
+    global summary_tokens
+    line = f"{question} → {answer[:SUMMARY_ANSWER_CHARS]}"
+    tokens = estimate_tokens(line)
+    summary_lines.append((line, tokens))
+    summary_tokens += tokens
+
+    while summary_tokens > SUMMARY_TOKEN_BUDGET and summary_lines:
+        summary_tokens -= summary_lines.popleft()[1]
+
+def add_exchange(question, answer):
+    # 记录一轮已完成的对话，超出预算的旧对话折叠进摘要
+    global history_tokens
+    tokens = estimate_tokens(question) + estimate_tokens(answer)
+    history.append((question, answer, tokens))
+    history_tokens += tokens
+
+    while history_tokens > HISTORY_TOKEN_BUDGET and len(history) > 1:
+        old_question, old_answer, old_tokens = history.popleft()
+        history_tokens -= old_tokens
+        fold_into_summary(old_question, old_answer)
+
+def get_summary():
+    # 返回缓存的滚动摘要文本
+    if not summary_lines:
+        return ""
+    return "之前的对话摘要：\n" + "\n".join(line for line, _ in summary_lines)
+
+def build_context(question, references):
+    # 在预算内组合上下文，返回 [(角色, 文本)]
+    # 优先级：当前问题 > 摘要 > 检索到的相关问答（按相关度） > 最近对话（从新到旧）
+    budget = CONTEXT_TOKEN_BUDGET - estimate_tokens(question)
+    summary = get_summary()
+    if summary and summary_tokens <= budget:
+        budget -= summary_tokens
+    else:
+        summary = ""
+
+    kept_references = []
+    for ref_question, ref_answer in references:
+        tokens = estimate_tokens(ref_question) + estimate_tokens(ref_answer)
+        if tokens > budget:
+            context_stats["dropped_references"] += 1
+            continue
+        kept_references.append((ref_question, ref_answer))
+        budget -= tokens
+
+    kept_history = []
+    for old_question, old_answer, tokens in reversed(history):
+        if tokens > budget:
+            break
+        kept_history.insert(0, (old_question, old_answer))
+        budget -= tokens
+
+    turns = [("system", summary)] if summary else []
+    for old_question, old_answer in kept_history + list(reversed(kept_references)): # 最相关的问答离当前问题最近
+        turns += [("user", old_question), ("assistant", old_answer)]
+    turns.append(("user", question))
+
+    prompt_tokens = CONTEXT_TOKEN_BUDGET - budget
+    context_stats["last_prompt_tokens"] = prompt_tokens
+    context_stats["max_prompt_tokens"] = max(context_stats["max_prompt_tokens"], prompt_tokens)
+    context_stats["last_items"] = len(turns)
+    context_stats["summary_tokens"] = summary_tokens
+    context_stats["history_turns"] = len(kept_history)
+    return turns
@@ -0,0 +1,103 @@
+import os
+import json
+import regex
+from status import update_status
+
+EMOTION_BACKEND = os.getenv("EMOTION_BACKEND", "lexicon") # 本地情绪检测后端：lexicon / model
+EMOTION_MODEL = os.getenv("EMOTION_MODEL", "") # 可选的文本分类模型，标签需与热键名称一致
+EMOTION_THRESHOLD = 2.0 # 得分达到该值立即触发表情
+EMOTION_MIN_SCORE = 1.0 # 回复结束时得分低于该值视为无法判断
+EMOTION_LABEL_LOG = os.getenv("EMOTION_LABEL_LOG", "") # 设置后每条回复都请求远程工具，把回复和远程给出的情绪写入该 JSONL 文件，用于评估本地检测
+
+# 情绪词典：关键词 -> 权重（回复中的 emoji 在检测前已被 TextStream 去除，不能作为关键词）
+EMOTION_LEXICON = {
+    "嘟嘴": {"哼": 2, "才不": 2, "不理你": 3, "生气": 2, "笨蛋": 2, "讨厌": 1, "不要": 1, "切": 1, "凭什么": 2},
+    "星星眼": {"哇": 2, "好厉害": 3, "厉害": 2, "太棒": 2, "好耶": 3, "期待": 2, "好酷": 2, "真的吗": 1, "好想": 1, "!!": 1, "！！": 1},
+    "爱心眼": {"喜欢": 2, "最爱": 3, "爱你": 3, "可爱": 2, "么么": 3, "好甜": 2, "心动": 3, "贴贴": 3},
+    "脸红": {"害羞": 3, "不好意思": 2, "才没有": 2, "人家": 1, "脸红": 3, "夸我": 2, "讨厌啦": 3, "羞": 2, "诶嘿": 2},
+    "脸黑": {"无语": 3, "烦": 2, "滚": 3, "闭嘴": 3, "恶心": 3, "可恶": 2, "废物": 3, "呵呵": 2, "找死": 3, "生气了": 2},
+}
+
+# 每种情绪预编译一个正则，一次扫描即可统计所有关键词
+EMOTION_PATTERNS = {
+    emotion: regex.compile("|".join(regex.escape(word) for word in sorted(words, key=len, reverse=True)))
+    for emotion, words in EMOTION_LEXICON.items()
+}
+
+def lexicon_scores(text):
+    # 词典打分：累加每种情绪命中的关键词权重
+    return {
+        emotion: sum(EMOTION_LEXICON[emotion][match] for match in pattern.findall(text))
+        for emotion, pattern in EMOTION_PATTERNS.items()
+    }
+
+classifier = None # 延迟加载的文本分类模型
+
+def model_scores(text):
+    # 模型打分：使用本地 CPU 文本分类模型，不可用时退回词典
+    global classifier, EMOTION_BACKEND
+    if classifier is None:
+        try:
+            from transformers import pipeline
+            classifier = pipeline("text-classification", model=EMOTION_MODEL, device=-1, top_k=None)
+        except Exception as e:
+            update_status(f"加载情绪模型失败，改用词典：{e}")
+            EMOTION_BACKEND = "lexicon"
+            return lexicon_scores(text)
+
+    results = classifier(text[:512])[0]
+    # 把概率映射到与词典相同的分数范围
+    return {result["label"]: result["score"] * EMOTION_THRESHOLD * 1.5 for result in results if result["label"] in EMOTION_LEXICON}
+
+BACKENDS = {
+    "lexicon": lexicon_scores,
+    "model": model_scores,
+}
+
+def detect_emotion(text):
+    # 返回得分最高的情绪和分数，没有命中时返回 ("无", 0)
+    scores = BACKENDS.get(EMOTION_BACKEND, lexicon_scores)(text)
+    emotion, score = max(scores.items(), key=lambda item: item[1], default=("无", 0))
+    return (emotion, score) if score > 0 else ("无", 0)
+
+def record_label(text, label):
+    # 追加一条远程标注
+    try:
+        with open(EMOTION_LABEL_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"text": text, "label": label}, ensure_ascii=False) + "\n")
+    except OSError as e:
+        update_status(f"记录情绪标注失败：{e}")
+
+def load_labels(path=None):
+    # 读取录制的远程标注，返回 [(回复, 情绪)]
+    with open(path or EMOTION_LABEL_LOG, encoding="utf-8") as f:
+        return [(item["text"], item["label"]) for item in map(json.loads, f) if item.get("text")]
+
+class EmotionStream:
+    # 对流式回复逐步检测情绪，每条回复最多触发一次表情
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        self.fired = None # 已触发的情绪
+
+    def feed(self, delta):
+        # 追加新文本，得分达到阈值时返回需要立即触发的情绪
+        self.text += delta
+        if self.fired:
+            return None
+
+        emotion, score = detect_emotion(self.text)
+        if score >= EMOTION_THRESHOLD:
+            self.fired = emotion
+            return emotion
+        return None
+
+    def finish(self):
+        # 回复结束：返回 (情绪, 是否已触发)，得分过低时情绪为 None
+        if self.fired:
+            return self.fired, True
+
+        emotion, score = detect_emotion(self.text)
+        return (emotion if score >= EMOTION_MIN_SCORE else None), False
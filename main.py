@@ -1,17 +1,18 @@
-from chat import process_pending_questions
+from chat import process_pending_questions, PREFETCH_MODE
 import time
-from status import processing
+from status import wait_for_turn, processing
 import stt
 
+RECHECK_INTERVAL = 30 # 没有任何通知时的兜底检查间隔（秒）
+
 def main():
     time.sleep(4) # 等待所有连接完成
 
     while True: 
-        if not processing(): # 确保不在处理状态中
+        # 空闲且有新记录、语音输入或播放结束时才唤醒，超时兜底检查也只在空闲时处理
+        # 预生成模式下播放期间也会唤醒，用来生成下一条回复
+        if wait_for_turn(RECHECK_INTERVAL, allow_speaking=PREFETCH_MODE) or not processing():
             process_pending_questions() 
-            time.sleep(1)
-            
-        time.sleep(0.1)
         
 if __name__ == "__main__":
     main() # 运行主程序
\ No newline at end of file
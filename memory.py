@@ -1,130 +1,763 @@
 import sqlite3
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 import random
+import threading
+import queue
+import time
+import atexit
+from collections import deque
 import os
+from status import update_status, processing, notify_work
+
+DB_PATH = os.getenv("CHAT_MEMORY_DB", "chat_memory.db") # 数据库文件路径
+
+# SQLite 连接参数：WAL 允许读写并发，busy_timeout 避免 "database is locked"
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL", # WAL 模式下 NORMAL 足够安全，且省去每次提交的 fsync
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000", # 约 8MB 页缓存
+]
+
+local = threading.local() # 每个线程持有自己的长连接
+connections = [] # 记录所有打开的连接，方便统一关闭
+connections_lock = threading.Lock()
+
+INGEST_BATCH_SIZE = 50 # 缓冲区达到该数量立即写入
+INGEST_FLUSH_INTERVAL = 0.5 # 最长缓冲时间（秒）
+ingest_queue = queue.Queue() # 等待写入的问题
+ingest_event = threading.Event() # 唤醒写入线程
+ingest_lock = threading.Lock() # 保证同一时间只有一次批量写入
+ingest_stats = { # 写入缓冲区统计
+    "queue_depth": 0,
+    "received": 0,
+    "written": 0,
+    "flushes": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+}
+
+def get_connection():
+    # 获取当前线程的数据库连接，不存在时创建
+    conn = getattr(local, "conn", None)
+    if conn is None or getattr(local, "path", None) != DB_PATH:
+        conn = sqlite3.connect(DB_PATH, timeout=5)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.execute("ATTACH DATABASE ? AS archive", (archive_path(),)) # 归档库
+        local.conn = conn
+        local.path = DB_PATH
+        with connections_lock:
+            connections.append(conn)
+    return conn
+
+def archive_path():
+    # 归档库与主数据库放在同一目录
+    return os.path.splitext(DB_PATH)[0] + "_archive.db"
+
+def close_connections():
+    # 关闭所有线程打开的连接
+    with connections_lock:
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.ProgrammingError:
+                pass # 连接属于其他线程时忽略
+        connections.clear()
+    local.conn = None
+
+# 数据库版本迁移，下标 + 1 即版本号，只能在末尾追加
+MIGRATIONS = [
+    [ # 1：聊天记录表
+        '''CREATE TABLE IF NOT EXISTS chat_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            event_type TEXT,
+            question TEXT,
+            response TEXT,
+            answered BOOLEAN
+        )''',
+    ],
+    [ # 2：待处理问题与去重查询的索引
+        "CREATE INDEX IF NOT EXISTS idx_records_pending ON chat_records (answered, event_type, id)",
+        "CREATE INDEX IF NOT EXISTS idx_records_user ON chat_records (event_type, user_id)",
+    ],
+    [ # 3：近似重复检测用的字符 n-gram 倒排索引
+        '''CREATE TABLE IF NOT EXISTS chat_ngrams (
+            event_type TEXT,
+            user_id TEXT,
+            gram TEXT,
+            record_id INTEGER,
+            PRIMARY KEY (event_type, user_id, gram, record_id)
+        ) WITHOUT ROWID''',
+        lambda conn: index_existing_records(conn),
+    ],
+    [ # 4：相似的未回答问题在插入时归入同一聚类
+        "ALTER TABLE chat_records ADD COLUMN cluster_id INTEGER",
+        "UPDATE chat_records SET cluster_id = id",
+        lambda conn: cluster_existing_records(conn),
+        "CREATE INDEX IF NOT EXISTS idx_records_cluster ON chat_records (cluster_id, answered)",
+    ],
+    [ # 5：记录写入时间，开启增量 VACUUM 以便归档后回收空间
+        "ALTER TABLE chat_records ADD COLUMN created_at REAL",
+        "UPDATE chat_records SET created_at = strftime('%s', 'now')", # 已有记录从迁移时开始计时
+        "CREATE INDEX IF NOT EXISTS idx_records_age ON chat_records (answered, event_type, created_at)",
+        "PRAGMA auto_vacuum = INCREMENTAL",
+        "VACUUM",
+    ],
+    [ # 6：FTS5 全文索引（trigram 分词支持中文），通过触发器与 chat_records 同步
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS chat_fts USING fts5(
+            question, response, content='chat_records', content_rowid='id', tokenize='trigram'
+        )''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat_records BEGIN
+            INSERT INTO chat_fts (rowid, question, response) VALUES (new.id, new.question, new.response);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat_records BEGIN
+            INSERT INTO chat_fts (chat_fts, rowid, question, response) VALUES ('delete', old.id, old.question, old.response);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_fts_update AFTER UPDATE OF question, response ON chat_records BEGIN
+            INSERT INTO chat_fts (chat_fts, rowid, question, response) VALUES ('delete', old.id, old.question, old.response);
+            INSERT INTO chat_fts (rowid, question, response) VALUES (new.id, new.question, new.response);
+        END''',
+        "INSERT INTO chat_fts (chat_fts) VALUES ('rebuild')",
+    ],
+    [ # 7：问题优先级，语音 > 会员/超级留言 > 普通弹幕
+        "ALTER TABLE chat_records ADD COLUMN priority INTEGER",
+        "UPDATE chat_records SET priority = CASE WHEN event_type = 'tts_message' THEN 0 ELSE 2 END",
+        "CREATE INDEX IF NOT EXISTS idx_records_priority ON chat_records (answered, priority, id)",
+    ],
+    [ # 8：按 n-gram 检索所有用户的记录，全文检索漏掉的问题用它补充
+        "CREATE INDEX IF NOT EXISTS idx_ngrams_gram ON chat_ngrams (gram, event_type)",
+    ],
+    [ # 9：没有回答就移出队列的原因，shed 为限流丢弃，expired 为等待超时
+        "ALTER TABLE chat_records ADD COLUMN dropped TEXT",
+    ],
+]
+
+# 优先级：数字越小越先回答；expire_seconds 为问题的最长等待时间，None 表示不过期
+PRIORITY_CLASSES = {
+    0: {"name": "voice", "expire_seconds": None},
+    1: {"name": "member", "expire_seconds": 900},
+    2: {"name": "chat", "expire_seconds": 300},
+}
+FAIR_CANDIDATES = 50 # 同一优先级中参与公平排队的候选数量
+MAX_BATCH_SIZE = 5 # 一轮最多合并回答的问题组数，设为 1 关闭合并回答
+BATCH_BACKLOG_STEP = 10 # 每积压这么多组问题，一轮多回答一组
+user_served = {} # user_id -> 上次被回答的时间，用于按用户轮流回答
+priority_stats = { # 各优先级的等待时间统计
+    level: {"answered": 0, "expired": 0, "total_wait": 0.0, "max_wait": 0.0}
+    for level in PRIORITY_CLASSES
+}
+
+def default_priority(event_type):
+    # 根据事件类型给出默认优先级
+    return 0 if event_type == "tts_message" else 2
+
+# 限流：可限流的积压超过高水位时抽样接收，超过临界水位时按策略削减回高水位
+HIGH_WATERMARK = 200
+CRITICAL_WATERMARK = 1000
+SHED_POLICY = "keep_popular" # keep_popular：保留人数最多的聚类；drop_oldest：丢弃最早的问题
+SHED_PRIORITY = 2 # 该优先级及以下的问题可以被限流
+DRAIN_WINDOW = 600 # 统计回答速度的时间窗口（秒）
+answer_times = deque() # 最近回答问题的时间
+shed_stats = {"mode": "normal", "backlog": 0, "drain_rate": 0.0, "sampled_out": 0, "shed": 0} # 限流统计
+
+# 归档库中的表结构，字段与 chat_records 对应
+ARCHIVE_SCHEMA = '''CREATE TABLE IF NOT EXISTS archive.chat_records (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT,
+    event_type TEXT,
+    question TEXT,
+    response TEXT,
+    answered BOOLEAN,
+    cluster_id INTEGER,
+    created_at REAL,
+    archived_at REAL,
+    dropped TEXT
+)'''
+ARCHIVE_COLUMNS = "id, user_id, event_type, question, response, answered, cluster_id, created_at, dropped"
+
+# 热表保留策略：超过天数或超过数量的已回答记录会移到归档库，未配置的类型使用 default
+RETENTION_POLICIES = {
+    "default": {"max_age_days": 30, "keep_answered": 5000},
+    "tts_message": {"max_age_days": 90, "keep_answered": 20000},
+}
+RETENTION_INTERVAL = 300 # 检查归档的间隔（秒）
+ARCHIVE_BATCH = 1000 # 每批归档的记录数量，避免长时间占用写锁
+VACUUM_PAGES = 500 # 每次增量 VACUUM 回收的页数
+
+ANSWER_CONTEXT = 3 # 每个问题附带的历史问答数量
+FTS_QUERY_GRAMS = 32 # 全文检索最多使用的 trigram 数量
+FTS_CANDIDATES = 20 # BM25 初筛数量，之后按相似度重新排序
+NGRAM_SIZE = 2 # 中文弹幕普遍很短，用二元组保证召回
+SIMILAR_CANDIDATES = 20 # 倒排索引筛出的候选数量，之后再用 fuzz.ratio 精确比较
+NGRAM_MAX_POSTINGS = 1000 # 检索已回答记录时跳过出现次数超过该值的二元组
+
+# 各事件类型的相似度算法和阈值，未配置的类型使用默认值
+SIMILARITY_SCORERS = {
+    "tts_message": {"scorer": fuzz.ratio, "threshold": 60},
+    "yt_message": {"scorer": fuzz.ratio, "threshold": 60},
+}
+DEFAULT_SCORER = {"scorer": fuzz.ratio, "threshold": 60}
+PARALLEL_CANDIDATES = 2000 # 候选数量超过该值时使用全部 CPU 核心
+
+def score_choices(event_type, question, choices):
+    # 批量计算 question 与所有候选的相似度，低于阈值的记为 0
+    config = SIMILARITY_SCORERS.get(event_type, DEFAULT_SCORER)
+    if not choices:
+        return [], config["threshold"]
+
+    scores = process.cdist(
+        [question or ""], [choice or "" for choice in choices],
+        scorer=config["scorer"],
+        score_cutoff=config["threshold"],
+        workers=-1 if len(choices) > PARALLEL_CANDIDATES else 1,
+    )[0]
+    return scores, config["threshold"]
+
+def similar_indexes(event_type, question, choices):
+    # 返回相似度达到阈值的候选下标
+    scores, threshold = score_choices(event_type, question, choices)
+    return [i for i, score in enumerate(scores) if score >= threshold]
+
+def make_ngrams(text):
+    # 把文本拆成字符 n-gram 集合
+    text = "".join((text or "").lower().split())
+    if len(text) <= NGRAM_SIZE:
+        return {text} if text else set()
+    return {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+
+def index_record(conn, record_id, user_id, event_type, question):
+    # 为一条记录写入 n-gram 倒排索引
+    conn.executemany(
+        "INSERT OR IGNORE INTO chat_ngrams (event_type, user_id, gram, record_id) VALUES (?, ?, ?, ?)",
+        [(event_type, user_id, gram, record_id) for gram in make_ngrams(question)],
+    )
+
+def index_existing_records(conn):
+    # 迁移时为已有记录补建索引
+    for record_id, user_id, event_type, question in conn.execute("SELECT id, user_id, event_type, question FROM chat_records").fetchall():
+        index_record(conn, record_id, user_id, event_type, question)
+
+def find_similar_record(conn, user_id, event_type, question):
+    # 通过倒排索引找到同一用户的相似问题，没有则返回 None
+    grams = list(make_ngrams(question))
+    if not grams:
+        return None
+
+    placeholders = ", ".join("?" * len(grams))
+    candidates = conn.execute(
+        f'''SELECT r.id, r.question FROM (
+                SELECT record_id, COUNT(*) AS hits FROM chat_ngrams
+                WHERE event_type = ? AND user_id = ? AND gram IN ({placeholders})
+                GROUP BY record_id ORDER BY hits DESC LIMIT ?
+            ) AS g JOIN chat_records AS r ON r.id = g.record_id''',
+        (event_type, user_id, *grams, SIMILAR_CANDIDATES),
+    ).fetchall()
+
+    matches = similar_indexes(event_type, question, [rec[1] for rec in candidates])
+    return candidates[matches[0]][0] if matches else None
+
+def find_cluster(conn, event_type, question):
+    # 找到同类型中相似的未回答聚类，只和每个聚类的首条记录比较
+    leaders = conn.execute(
+        "SELECT id, question FROM chat_records WHERE answered = 0 AND event_type = ? AND id = cluster_id",
+        (event_type,),
+    ).fetchall()
+
+    matches = similar_indexes(event_type, question, [rec[1] for rec in leaders])
+    return leaders[matches[0]][0] if matches else None
+
+def cluster_existing_records(conn):
+    # 迁移时把已有的相似未回答问题归入同一聚类，和插入时一样只与每个聚类的首条记录比较
+    leaders = {} # event_type -> [(问题, 聚类 ID)]
+    updates = []
+    for record_id, event_type, question in conn.execute(
+        "SELECT id, event_type, question FROM chat_records WHERE answered = 0 ORDER BY id"
+    ).fetchall():
+        event_leaders = leaders.setdefault(event_type, [])
+        matches = similar_indexes(event_type, question, [leader[0] for leader in event_leaders])
+        if matches:
+            updates.append((event_leaders[matches[0]][1], record_id))
+        else:
+            event_leaders.append((question, record_id))
+    conn.executemany("UPDATE chat_records SET cluster_id = ? WHERE id = ?", updates)
 
 def init_db():
-    # 初始化数据库
-    conn = sqlite3.connect("chat_memory.db")
-    cursor = conn.cursor()
-    cursor.execute('''CREATE TABLE IF NOT EXISTS chat_records (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id TEXT,
-                        event_type TEXT,
-                        question TEXT,
-                        response TEXT,
-                        answered BOOLEAN
-                    )''')
-    conn.commit()
-    conn.close()
-
-if not os.path.exists("chat_memory.db"): # 没有 chat_memory.db 就创建
-    init_db()
-
-def save_chat_record(user_id, event_type, question):
-    # 保存用户问题
-    conn = sqlite3.connect("chat_memory.db")
-    cursor = conn.cursor()
-
-    if event_type == "tts_message": # 直接存入数据库
-        cursor.execute('''INSERT INTO chat_records (user_id, event_type, question, answered)
-                          VALUES (?, ?, ?, ?)''', (user_id, event_type, question, False))
-        conn.commit()
-        conn.close()
-        return
-    
-    # 查询现有记录，检查是否有相似的问题
-    cursor.execute("SELECT id, question FROM chat_records WHERE event_type = ? AND user_id = ?", (event_type, user_id))
-    records = cursor.fetchall()
-
-    for rec in records:  # 检查是否已有相似记录（相似度 >= 60%）
-        if fuzz.ratio(question, rec[1]) >= 60:
-            conn.close()
-            return  
-
-    # 没有相似问题，则存入数据库
-    cursor.execute('''INSERT INTO chat_records (user_id, event_type, question, answered)
-                      VALUES (?, ?, ?, ?)''', (user_id, event_type, question, False))
-    conn.commit()
-    conn.close()
+    # 初始化数据库，并把旧数据库升级到最新版本
+    conn = get_connection()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    # 默认模式下 ALTER/CREATE 会自动提交，改为手动事务，保证每个版本的迁移和版本号一起提交或回滚
+    conn.isolation_level = None
+    try:
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            after_commit = [] # VACUUM 不能在事务中执行
+            conn.execute("BEGIN")
+            try:
+                for statement in statements:
+                    if callable(statement): # 需要 Python 处理的数据迁移
+                        statement(conn)
+                    elif statement.startswith("VACUUM"):
+                        after_commit.append(statement)
+                    else:
+                        conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {number}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            for statement in after_commit:
+                conn.execute(statement)
+    finally:
+        conn.isolation_level = "" # 恢复默认的事务模式
+
+    with conn:
+        conn.execute(ARCHIVE_SCHEMA)
+        if "dropped" not in {rec[1] for rec in conn.execute("PRAGMA archive.table_info(chat_records)")}: # 旧版归档库补上字段
+            conn.execute("ALTER TABLE archive.chat_records ADD COLUMN dropped TEXT")
+
+RECORD_COLUMNS = "id, user_id, event_type, question, response, answered"
+JOINED_COLUMNS = "r.id, r.user_id, r.event_type, r.question, r.response, r.answered" # 联表查询时使用
+
+def format_record(rec):
+    # 把查询结果转换为字典
+    return {
+        "id": rec[0],
+        "user_id": rec[1],
+        "event_type": rec[2],
+        "question": rec[3],
+        "response": rec[4],
+        "answered": bool(rec[5]),
+    }
+
+def dedup_batch(batch):
+    # 在内存中去掉同一用户在同一批次内的相似消息（tts_message 不去重）
+    kept = []
+    seen = {} # (user_id, event_type) -> 已保留的问题
+
+    for user_id, event_type, question, priority in batch:
+        if event_type != "tts_message":
+            questions = seen.setdefault((user_id, event_type), [])
+            if similar_indexes(event_type, question, questions):
+                continue
+            questions.append(question)
+        kept.append((user_id, event_type, question, priority))
+
+    return kept
+
+def insert_records(conn, batch):
+    # 在一个事务内批量保存问题，返回实际写入的数量
+    conn.execute("BEGIN IMMEDIATE") # 提前拿到写锁，保证预先分配的 ID 不会冲突
+    sequence = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chat_records'").fetchone()
+    next_id = (sequence[0] if sequence else 0) + 1
+
+    rows = []
+    new_leaders = {} # event_type -> [(问题, 聚类 ID)]，本批次新建的聚类
+
+    for user_id, event_type, question, priority in batch:
+        # tts_message 直接存入数据库，其他类型检查是否已有相似记录
+        if event_type != "tts_message" and find_similar_record(conn, user_id, event_type, question) is not None:
+            continue
+
+        # 加入相似问题的聚类（没有则自成一类）
+        record_id = next_id + len(rows)
+        cluster_id = find_cluster(conn, event_type, question)
+        if cluster_id is None:
+            leaders = new_leaders.setdefault(event_type, [])
+            matches = similar_indexes(event_type, question, [leader[0] for leader in leaders])
+            cluster_id = leaders[matches[0]][1] if matches else record_id
+            if not matches:
+                leaders.append((question, record_id))
+
+        if priority is None:
+            priority = default_priority(event_type)
+        rows.append((record_id, user_id, event_type, question, False, cluster_id, time.time(), priority))
+
+    conn.executemany('''INSERT INTO chat_records (id, user_id, event_type, question, answered, cluster_id, created_at, priority)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    conn.executemany(
+        "INSERT OR IGNORE INTO chat_ngrams (event_type, user_id, gram, record_id) VALUES (?, ?, ?, ?)",
+        [(row[2], row[1], gram, row[0]) for row in rows for gram in make_ngrams(row[3])],
+    )
+    return len(rows)
+
+def save_chat_record(user_id, event_type, question, priority=None):
+    # 立即保存用户问题，priority 为空时按事件类型决定
+    conn = get_connection()
+    with conn: # 自动提交或回滚
+        written = insert_records(conn, [(user_id, event_type, question, priority)])
+
+    if written:
+        notify_work() # 唤醒调度处理新问题
+
+def queue_chat_record(user_id, event_type, question, priority=None):
+    # 把问题放入写入缓冲区，由后台线程批量保存
+    ingest_queue.put((user_id, event_type, question, priority))
+    ingest_stats["queue_depth"] = ingest_queue.qsize()
+    if ingest_queue.qsize() >= INGEST_BATCH_SIZE:
+        ingest_event.set() # 达到批量大小，立即写入
+
+def shed_level(priority, event_type):
+    # 只对普通弹幕限流，语音和会员消息始终保留
+    return (priority if priority is not None else default_priority(event_type)) >= SHED_PRIORITY
+
+def chat_backlog(conn):
+    # 可限流的未回答问题数量
+    return conn.execute("SELECT COUNT(*) FROM chat_records WHERE answered = 0 AND priority >= ?", (SHED_PRIORITY,)).fetchone()[0]
+
+def drain_rate():
+    # 最近一段时间每分钟回答的问题组数
+    now = time.time()
+    while answer_times and now - answer_times[0] > DRAIN_WINDOW:
+        answer_times.popleft()
+    return len(answer_times) * 60 / DRAIN_WINDOW
+
+def sample_batch(conn, batch):
+    # 积压超过高水位时，按 高水位 / 积压 的比例抽样接收普通弹幕
+    backlog = chat_backlog(conn)
+    shed_stats["backlog"] = backlog
+    shed_stats["drain_rate"] = drain_rate()
+    if backlog <= HIGH_WATERMARK:
+        shed_stats["mode"] = "normal"
+        return batch
+
+    shed_stats["mode"] = "sampling"
+    ratio = HIGH_WATERMARK / backlog
+    kept = [item for item in batch if not shed_level(item[3], item[1]) or random.random() < ratio]
+    shed_stats["sampled_out"] += len(batch) - len(kept)
+    return kept
+
+def shed_backlog(conn):
+    # 积压超过临界水位时，按聚类整组丢弃普通弹幕，直到积压回到高水位
+    backlog = chat_backlog(conn)
+    if backlog <= CRITICAL_WATERMARK:
+        return 0
+
+    if SHED_POLICY == "keep_popular": # 丢弃人数最少的聚类，保留大家都在问的问题
+        order = "COUNT(*), MIN(id)"
+    else: # drop_oldest：丢弃最早的问题
+        order = "MIN(id)"
+    clusters = conn.execute(
+        f'''SELECT cluster_id, COUNT(*) FROM chat_records WHERE answered = 0
+            GROUP BY cluster_id HAVING MIN(priority) >= ? ORDER BY {order}''',
+        (SHED_PRIORITY,),
+    ).fetchall() # 含有语音或会员消息的聚类整组保留
+
+    excess, dropped = backlog - HIGH_WATERMARK, []
+    for cluster_id, size in clusters:
+        if excess <= 0:
+            break
+        if size > excess: # 只剩少量需要削减时不整组丢弃更大的聚类，保留大家都在问的问题
+            continue
+        dropped.append((cluster_id,))
+        excess -= size
+
+    with conn:
+        cursor = conn.executemany(
+            "UPDATE chat_records SET answered = 1, dropped = 'shed' WHERE cluster_id = ? AND answered = 0", dropped
+        )
+    shed_stats["mode"] = SHED_POLICY
+    shed_stats["shed"] += cursor.rowcount
+    return cursor.rowcount
+
+def flush_ingest():
+    # 把缓冲区的问题一次性写入数据库
+    with ingest_lock:
+        batch = []
+        while True:
+            try:
+                batch.append(ingest_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        ingest_stats["queue_depth"] = ingest_queue.qsize()
+        if not batch:
+            return 0
+
+        start = time.perf_counter()
+        conn = get_connection()
+        kept = sample_batch(conn, dedup_batch(batch)) # 积压过多时抽样接收
+        with conn:
+            written = insert_records(conn, kept)
+        shed_backlog(conn) # 超过上限时按策略丢弃积压
+
+        if written:
+            notify_work() # 唤醒调度处理新问题
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        ingest_stats["flushes"] += 1
+        ingest_stats["received"] += len(batch)
+        ingest_stats["written"] += written
+        ingest_stats["last_flush_ms"] = elapsed_ms
+        ingest_stats["max_flush_ms"] = max(ingest_stats["max_flush_ms"], elapsed_ms)
+        return written
+
+def archive_batch(conn, event_type, policy):
+    # 按策略把一批过期的已回答记录移到归档库，返回移动的数量
+    cutoff = time.time() - policy["max_age_days"] * 86400
+    newest_kept = conn.execute(
+        "SELECT id FROM chat_records WHERE answered = 1 AND event_type = ? ORDER BY id DESC LIMIT 1 OFFSET ?",
+        (event_type, policy["keep_answered"]),
+    ).fetchone() # 超出保留数量的第一条记录
+    rows = conn.execute(
+        '''SELECT id, user_id, event_type, question FROM chat_records
+           WHERE answered = 1 AND event_type = ? AND (created_at < ? OR id <= ?)
+           ORDER BY id LIMIT ?''',
+        (event_type, cutoff, newest_kept[0] if newest_kept else 0, ARCHIVE_BATCH),
+    ).fetchall()
+    if not rows:
+        return 0
+
+    ids = [(rec[0],) for rec in rows]
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS archive_ids (id INTEGER PRIMARY KEY)")
+        conn.execute("DELETE FROM archive_ids")
+        conn.executemany("INSERT INTO archive_ids (id) VALUES (?)", ids)
+        conn.execute(
+            f'''INSERT OR REPLACE INTO archive.chat_records ({ARCHIVE_COLUMNS}, archived_at)
+                SELECT {ARCHIVE_COLUMNS}, ? FROM chat_records WHERE id IN (SELECT id FROM archive_ids)''',
+            (time.time(),),
+        )
+        conn.executemany(
+            "DELETE FROM chat_ngrams WHERE event_type = ? AND user_id = ? AND gram = ? AND record_id = ?",
+            [(rec[2], rec[1], gram, rec[0]) for rec in rows for gram in make_ngrams(rec[3])],
+        )
+        conn.execute("DELETE FROM chat_records WHERE id IN (SELECT id FROM archive_ids)")
+    return len(rows)
+
+def run_retention():
+    # 空闲时按策略归档旧记录并回收空间，直播处理问题时立即让出
+    conn = get_connection()
+    archived = 0
+    event_types = [rec[0] for rec in conn.execute("SELECT DISTINCT event_type FROM chat_records WHERE answered = 1")]
+
+    for event_type in event_types:
+        policy = RETENTION_POLICIES.get(event_type, RETENTION_POLICIES["default"])
+        while not processing():
+            moved = archive_batch(conn, event_type, policy)
+            archived += moved
+            if moved < ARCHIVE_BATCH:
+                break
+
+    if not processing():
+        conn.execute(f"PRAGMA incremental_vacuum({VACUUM_PAGES})").fetchall()
+    return archived
+
+def get_archived_records(user_id=None, event_type=None, limit=100):
+    # 查询归档库中的记录，最新的在前
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    if event_type is not None:
+        conditions.append("event_type = ?")
+        params.append(event_type)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = get_connection().execute(
+        f"SELECT {RECORD_COLUMNS} FROM archive.chat_records {where} ORDER BY id DESC LIMIT ?",
+        (*params, limit),
+    ).fetchall()
+    return [format_record(rec) for rec in rows]
+
+def retention_worker():
+    # 后台线程：定期在空闲时执行归档
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        if processing():
+            continue
+        try:
+            run_retention()
+        except Exception as e:
+            update_status(f"归档聊天记录失败：{e}")
+
+def ingest_worker():
+    # 后台线程：按时间或数量触发批量写入
+    while True:
+        ingest_event.wait(INGEST_FLUSH_INTERVAL)
+        ingest_event.clear()
+        try:
+            flush_ingest()
+        except Exception as e:
+            update_status(f"批量保存聊天记录失败：{e}")
 
 def update_chat_response(record_id, response):
-    # 更新问题回复
-    conn = sqlite3.connect("chat_memory.db")
-    cursor = conn.cursor()
-    cursor.execute("UPDATE chat_records SET response = ?, answered = ? WHERE id = ?", (response, True, record_id))
-    conn.commit()
-    conn.close()
-
-def get_records():
-    # 获取过滤过的纪录
-    conn = sqlite3.connect("chat_memory.db")
-    cursor = conn.cursor()
-    
-    # 读取所有记录
-    cursor.execute("SELECT id, user_id, event_type, question, response, answered FROM chat_records")
-    records = cursor.fetchall()
-    conn.close()
-    
-    if not records:
-        return None, None  # 如果没有记录，直接返回 None
-    
-    # 处理数据格式
-    formatted_records = [
-        {
-            "id": rec[0],
-            "user_id": rec[1],
-            "event_type": rec[2],
-            "question": rec[3],
-            "response": rec[4],
-            "answered": bool(rec[5]),
-        }
-        for rec in records
+    # 更新问题回复，同一聚类中未回答的问题一并标记为已回答
+    conn = get_connection()
+    record = conn.execute(
+        '''SELECT r.user_id, r.priority, MIN(p.created_at) FROM chat_records AS r
+           LEFT JOIN chat_records AS p ON p.cluster_id = r.cluster_id AND p.answered = 0
+           WHERE r.id = ?''',
+        (record_id,),
+    ).fetchone()
+
+    if record and record[0] is not None: # 记录等待时间和回答的用户
+        user_served[record[0]] = time.time()
+        answer_times.append(time.time())
+        stats = priority_stats.get(record[1])
+        if stats and record[2] is not None: # 没有写入时间的记录不计入等待时间
+            wait = time.time() - record[2]
+            stats["answered"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+
+    with conn:
+        conn.execute(
+            '''UPDATE chat_records SET response = ?, answered = ?
+               WHERE cluster_id = (SELECT cluster_id FROM chat_records WHERE id = ?) AND (answered = 0 OR id = ?)''',
+            (response, True, record_id, record_id),
+        )
+
+def fts_query(text):
+    # 把问题拆成 trigram 短语的 OR 查询，问题太短时返回 None
+    text = "".join((text or "").split())
+    grams = list(dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2)))[:FTS_QUERY_GRAMS]
+    if not grams:
+        return None
+    return " OR ".join('"' + gram.replace('"', '""') + '"' for gram in grams)
+
+def rank_answers(event_type, question, rows, k):
+    # 按相似度重新排序，只保留达到阈值的记录，同一聚类只取最相似的一条
+    scores, threshold = score_choices(event_type, question, [rec[3] for rec in rows])
+    ranked, seen = [], set()
+    for i in sorted((i for i, score in enumerate(scores) if score >= threshold), key=lambda i: -scores[i]):
+        if rows[i][6] not in seen:
+            seen.add(rows[i][6])
+            ranked.append(rows[i])
+    return ranked[:k]
+
+def search_answers(question, event_type=None, k=ANSWER_CONTEXT):
+    # 检索与问题最相似的 k 条已回答记录：先用全文索引按 BM25 初筛，不足 k 条时再用二元组倒排索引补充候选
+    conn = get_connection()
+    query = fts_query(question)
+    type_filter = "AND r.event_type = ?" if event_type else ""
+    params = (event_type,) if event_type else ()
+
+    rows = []
+    if query is not None:
+        rows = conn.execute(
+            f'''SELECT {JOINED_COLUMNS}, COALESCE(r.cluster_id, r.id) FROM chat_fts
+                JOIN chat_records AS r ON r.id = chat_fts.rowid
+                WHERE chat_fts MATCH ? AND r.answered = 1 AND r.response IS NOT NULL {type_filter}
+                ORDER BY bm25(chat_fts, 1.0, 0.3) LIMIT ?''',
+            (query, *params, FTS_CANDIDATES),
+        ).fetchall()
+        ranked = rank_answers(event_type, question, rows, k)
+        if len(ranked) >= k:
+            return [format_record(rec) for rec in ranked]
+
+    # 问题太短或换了说法（trigram 不重合）时全文检索会漏掉，按共有的二元组数量补充所有用户的已回答记录
+    # 只使用出现次数不超过 NGRAM_MAX_POSTINGS 的二元组，“主播”这类常见词的倒排列表太长，扫描代价过高
+    gram_filter = "AND g.event_type = ?" if event_type else ""
+    grams = [
+        gram for gram in make_ngrams(question)
+        if conn.execute(
+            f"SELECT COUNT(*) FROM (SELECT 1 FROM chat_ngrams AS g WHERE g.gram = ? {gram_filter} LIMIT ?)",
+            (gram, *params, NGRAM_MAX_POSTINGS + 1),
+        ).fetchone()[0] <= NGRAM_MAX_POSTINGS
     ]
-    
+    if grams:
+        found = {rec[0] for rec in rows}
+        placeholders = ", ".join("?" * len(grams))
+        candidates = conn.execute(
+            f'''SELECT {JOINED_COLUMNS}, COALESCE(r.cluster_id, r.id) FROM chat_ngrams AS g
+                JOIN chat_records AS r ON r.id = g.record_id
+                WHERE g.gram IN ({placeholders}) AND r.answered = 1 AND r.response IS NOT NULL {gram_filter}
+                GROUP BY g.record_id ORDER BY COUNT(*) DESC LIMIT ?''',
+            (*grams, *params, SIMILAR_CANDIDATES + len(found)),
+        ).fetchall()
+        rows += [rec for rec in candidates if rec[0] not in found]
+    return [format_record(rec) for rec in rank_answers(event_type, question, rows, k)]
+
+def pending_ids(record_ids):
+    # 返回仍未回答的记录 ID
+    if not record_ids:
+        return []
+    placeholders = ", ".join("?" * len(record_ids))
+    rows = get_connection().execute(
+        f"SELECT id FROM chat_records WHERE answered = 0 AND id IN ({placeholders}) ORDER BY id", tuple(record_ids)
+    ).fetchall()
+    return [rec[0] for rec in rows]
+
+def expire_records(conn):
+    # 把等待太久的问题聚类整组标记为已回答（回复为空），不再占用队列
+    # 按聚类中最新的问题计时，聚类首条过期后其余问题也不会脱离聚类；没有写入时间的问题视为已过期
+    now = time.time()
+    for level, config in PRIORITY_CLASSES.items():
+        if config["expire_seconds"] is None:
+            continue
+        with conn:
+            cursor = conn.execute(
+                '''UPDATE chat_records SET answered = 1, dropped = 'expired' WHERE answered = 0 AND cluster_id IN (
+                       SELECT cluster_id FROM chat_records WHERE answered = 0 GROUP BY cluster_id
+                       HAVING MIN(priority) = ? AND MAX(COALESCE(created_at, 0)) < ?
+                   )''',
+                (level, now - config["expire_seconds"]),
+            )
+        priority_stats[level]["expired"] += cursor.rowcount
+
+def pick_pending(conn, exclude, params):
+    # 按优先级选出下一个问题，同一优先级内优先回答最久没被回答过的用户
+    for level in sorted(PRIORITY_CLASSES):
+        candidates = conn.execute(
+            f"SELECT {RECORD_COLUMNS}, cluster_id FROM chat_records WHERE answered = 0 AND priority = ? {exclude} ORDER BY id LIMIT ?",
+            (level, *params, FAIR_CANDIDATES),
+        ).fetchall()
+        if candidates:
+            return min(candidates, key=lambda rec: (user_served.get(rec[1], 0), rec[0]))
+    return None
+
+def pending_backlog():
+    # 待回答的问题聚类数量
+    return get_connection().execute("SELECT COUNT(*) FROM chat_records WHERE answered = 0 AND id = cluster_id").fetchone()[0]
+
+def adaptive_batch_size():
+    # 积压越多，一轮回答的问题越多
+    return max(1, min(MAX_BATCH_SIZE, 1 + pending_backlog() // BATCH_BACKLOG_STEP))
+
+def get_records(exclude_ids=(), batch_size=1):
+    # 获取过滤过的纪录：未回答的问题（最多 batch_size 组，None 表示按积压自动调整）在前，相关的已回答记录在后
+    # 返回的 ID 每组一个，用 update_chat_response 标记时整组一并回答；exclude_ids 所在的聚类不会被选中
+    conn = get_connection()
+    expire_records(conn)
+    if batch_size is None:
+        batch_size = adaptive_batch_size()
+
     records_list = []
-    id_list = []
-    
-    for record in formatted_records: # 遍历所有记录，查找未回答的问题
-        if not record.get("answered", False):
-            if record["event_type"] == "tts_message": # 处理 TTS 类型
-                similar_records = [
-                    rec for rec in formatted_records
-                    if not rec.get("answered", False)
-                    and rec["id"] != record["id"]
-                    and rec["event_type"] == "tts_message"
-                    and fuzz.ratio(record.get("question", ""), rec.get("question", "")) >= 60
-                ]
-            else: # 处理 YouTube 类型
-                similar_records = [
-                    rec for rec in formatted_records
-                    if not rec.get("answered", False)
-                    and rec["id"] != record["id"]
-                    and rec["event_type"] == "yt_message"
-                    and fuzz.ratio(record.get("question", ""), rec.get("question", "")) >= 60
-                ]
-
-            similar_records.append(record) # 加入目前的纪录
-
-            for rec in similar_records:
-                id_list.append(rec["id"])  # 将 ID 添加到列表中
-
-            chosen_record = random.choice(similar_records) # 随机选择一个相似的问题
-            records_list.append(chosen_record)
-            break  # 处理完一个未回答的问题后跳出循环
+    id_list = list(exclude_ids)
+
+    while len(records_list) < batch_size:
+        placeholders = ", ".join("?" * len(id_list))
+        exclude = f"AND cluster_id NOT IN (SELECT cluster_id FROM chat_records WHERE id IN ({placeholders}))" if id_list else ""
+        pending = pick_pending(conn, exclude, tuple(id_list))
+        if not pending:
+            break
+        if records_list and (pending[2] == "tts_message" or records_list[0]["event_type"] == "tts_message"):
+            break # 主播语音单独回答
+
+        # 通过聚类索引取出整组相似的未回答问题
+        cluster = conn.execute(
+            f"SELECT {RECORD_COLUMNS} FROM chat_records WHERE cluster_id = ? AND answered = 0",
+            (pending[6],),
+        ).fetchall()
+        similar_records = [format_record(rec) for rec in cluster]
+
+        id_list.extend(rec["id"] for rec in similar_records) # 将 ID 添加到列表中
+        records_list.append(random.choice(similar_records)) # 随机选择一个相似的问题
 
     if not records_list:
         return None, None # 如果没有待处理问题，返回 None
-    
-    # 仅和相同类型的已回答记录比较
-    similar_records = [
-        rec for rec in formatted_records
-        if rec.get("answered", False)
-        and rec.get("event_type") == records_list[0]["event_type"]
-        and fuzz.ratio(records_list[0]["question"], rec.get("question", "")) >= 60
-    ]
-        
-    if similar_records:
-        records_list.append(random.choice(similar_records))  # 随机选择一个已回答的相似问题
-    
-    return records_list, id_list
\ No newline at end of file
+
+    picked_ids = [rec["id"] for rec in records_list] # 每个聚类一个代表
+
+    # 附带同类型中最相关的几条已回答记录作为上下文
+    records_list.extend(search_answers(records_list[0]["question"], records_list[0]["event_type"]))
+
+    return records_list, picked_ids
+
+init_db() # 确保数据库为最新版本
+atexit.register(flush_ingest) # 退出前写入缓冲区中剩余的问题
+threading.Thread(target=ingest_worker, daemon=True).start()
+threading.Thread(target=retention_worker, daemon=True).start()
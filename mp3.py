@@ -0,0 +1,160 @@
+# 直接解析内存中的 MP3 数据获取时长，不写临时文件、不启动 ffmpeg
+
+# 码率表（kbps），按 (MPEG 版本是否为 1, 层) 索引，下标 0 为自由码率（不支持）
+BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)} # 按版本位索引：3=MPEG1，2=MPEG2，0=MPEG2.5
+
+def parse_header(data, pos):
+    # 解析 pos 处的帧头，返回 (帧长度, 每帧采样数, 采样率, 帧头信息)，无效时返回 None
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[pos + 1] >> 3) & 0x03
+    layer = 4 - ((data[pos + 1] >> 1) & 0x03)
+    bitrate_index = data[pos + 2] >> 4
+    rate_index = (data[pos + 2] >> 2) & 0x03
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (data[pos + 2] >> 1) & 0x01
+    mono = data[pos + 3] >> 6 == 3
+
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if mpeg1 or layer == 2 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    return length, samples, sample_rate, (mpeg1, layer, mono)
+
+def id3_size(data, pos):
+    # ID3v2 标签的总长度，不是标签时返回 0
+    if data[pos:pos + 3] != b"ID3" or pos + 10 > len(data):
+        return 0
+    size = 0
+    for byte in data[pos + 6:pos + 10]: # 同步安全整数，每字节 7 位
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[pos + 5] & 0x10 else 0
+    return 10 + size + footer
+
+def vbr_frames(data, pos, info):
+    # 读取 Xing/Info 或 VBRI 头中的帧数和字节数，没有时返回 None
+    mpeg1, layer, mono = info
+    if layer != 3:
+        return None
+
+    side_info = (17 if mono else 32) if mpeg1 else (9 if mono else 17)
+    offset = pos + 4 + side_info
+    if data[offset:offset + 4] in (b"Xing", b"Info"):
+        flags = int.from_bytes(data[offset + 4:offset + 8], "big")
+        if not flags & 0x01:
+            return None
+        frames = int.from_bytes(data[offset + 8:offset + 12], "big")
+        size = int.from_bytes(data[offset + 12:offset + 16], "big") if flags & 0x02 else None
+        return frames, size
+
+    offset = pos + 36
+    if data[offset:offset + 4] == b"VBRI":
+        size = int.from_bytes(data[offset + 10:offset + 14], "big")
+        frames = int.from_bytes(data[offset + 14:offset + 18], "big")
+        return frames, size
+    return None
+
+def mp3_duration(data):
+    # 计算 MP3 数据的时长（秒）：优先使用 Xing/VBRI 头，否则逐帧累加
+    pos, duration, first = 0, 0.0, True
+    end = len(data)
+
+    while pos + 4 <= end:
+        tag = id3_size(data, pos)
+        if tag:
+            pos += tag
+            continue
+
+        header = parse_header(data, pos)
+        if header is None or pos + header[0] > end: # 不是帧头或最后一帧不完整，向后重新同步
+            pos = data.find(b"\xff", pos + 1) if header is None else end
+            if pos < 0:
+                break
+            continue
+
+        length, samples, sample_rate, info = header
+        vbr = vbr_frames(data, pos, info)
+        if vbr:
+            frames, size = vbr
+            # 头部声明的大小覆盖全部剩余数据时直接使用，否则（多段拼接）跳过该头帧继续逐帧累加
+            if first and size is not None and size >= end - pos - length:
+                return frames * samples / sample_rate
+        else:
+            duration += samples / sample_rate
+        first = False
+        pos += length
+
+    return duration
+
+class FrameReader:
+    # 把任意切分的 MP3 数据流重新切成完整帧，不完整的尾部留到下一次
+    def __init__(self):
+        self.pending = b""
+
+    def reset(self):
+        # 新的音频流开始时丢弃残留数据
+        self.pending = b""
+
+    def feed(self, data: bytes):
+        # 返回 (完整帧的数据, 这些帧的时长)
+        data = self.pending + data
+        pos, duration = 0, 0.0
+
+        while pos + 4 <= len(data):
+            tag = id3_size(data, pos)
+            if tag:
+                if pos + tag > len(data): # 标签还没收完整
+                    break
+                pos += tag
+                continue
+
+            header = parse_header(data, pos)
+            if header is None: # 向后重新同步
+                pos = data.find(b"\xff", pos + 1)
+                if pos < 0:
+                    pos = len(data)
+                continue
+
+            length, samples, sample_rate, info = header
+            if pos + length > len(data): # 帧还没收完整
+                break
+            if not vbr_frames(data, pos, info): # Xing/VBRI 头帧不含音频
+                duration += samples / sample_rate
+            pos += length
+
+        self.pending = data[pos:]
+        return data[:pos], duration
+
+def frame_offsets(data):
+    # 依次返回完整帧的 (起始位置, 帧头信息)，跳过标签和无法识别的字节
+    pos = 0
+    while pos + 4 <= len(data):
+        tag = id3_size(data, pos)
+        if tag:
+            pos += tag
+            continue
+        header = parse_header(data, pos)
+        if header is None:
+            pos = data.find(b"\xff", pos + 1)
+            if pos < 0:
+                return
+            continue
+        if pos + header[0] > len(data):
+            return
+        yield pos, header
+        pos += header[0]
@@ -0,0 +1,56 @@
+import regex
+
+# 预编译的匹配规则，只在导入时编译一次
+EMOJI_PATTERN = regex.compile(r"[\p{Extended_Pictographic}\p{Emoji_Modifier}\u200d\ufe0f]") # 不包括 \p{Emoji} 中的数字和 #*
+SPACE_PATTERN = regex.compile(r"\s+")
+SENTENCE_END = set("。！？!?…\n") # 句子结束
+CLAUSE_END = set("，、；：,;:") # 分句结束
+
+class TextStream:
+    # 流式文本规范化：每个增量只处理一次，遇到中英文标点时把分句/句子推送给订阅者
+    def __init__(self):
+        self.subscribers = [] # 回调函数 callback(文本, 类型)，类型为 "clause" 或 "sentence"
+        self.reset()
+
+    def reset(self):
+        self.text = "" # 本条回复规范化后的全部文本
+        self.pending = "" # 尚未推送的分句
+        self.period = False # 上一个字符是英文句点，要看下一个字符才能确定是否断句
+
+    def subscribe(self, callback):
+        # 订阅分句事件
+        self.subscribers.append(callback)
+
+    def emit(self, kind):
+        # 推送当前分句
+        segment = SPACE_PATTERN.sub(" ", self.pending).strip()
+        self.pending = ""
+        if segment:
+            for callback in self.subscribers:
+                callback(segment, kind)
+
+    def feed(self, delta):
+        # 处理一个增量，返回规范化后的文本
+        clean = EMOJI_PATTERN.sub("", delta)
+        self.text += clean
+
+        for char in clean:
+            if self.period: # 句点后跟空白才是句子结束，3.5 这样的小数不断句
+                self.period = False
+                if char.isspace():
+                    self.emit("sentence")
+            self.pending += char
+            if char in SENTENCE_END:
+                self.emit("sentence")
+            elif char == ".":
+                self.period = True
+            elif char in CLAUSE_END:
+                self.emit("clause")
+        return clean
+
+    def finish(self):
+        # 回复结束，推送剩余文本并返回全部规范化文本
+        self.emit("sentence")
+        text = self.text.strip()
+        self.reset()
+        return text
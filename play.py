@@ -2,25 +2,152 @@ import queue
 import threading
 import subprocess
 import shutil
+import time
+import os
+from mp3 import FrameReader, mp3_duration
+import audio_engine
+
+AUDIO_BACKEND = os.getenv("AUDIO_BACKEND", "auto") # auto：安装了 miniaudio 时使用进程内输出引擎，失败时回退到 ffplay；engine / ffplay：指定
+
+# 流式播放的抖动缓冲：缓冲够 JITTER_TARGET 秒音频，或首块到达后等待超过 JITTER_MAX_WAIT 秒即开始播放
+JITTER_TARGET = 0.06
+JITTER_MAX_WAIT = 0.03
+STREAM_ARGS = ["ffplay", "-nodisp", "-loglevel", "quiet", "-volume", "100",
+               "-fflags", "nobuffer", "-flags", "low_delay", "-probesize", "32", "-analyzeduration", "0",
+               "-f", "mp3", "-"] # 常驻进程，从标准输入持续读取 MP3 帧
+
+class PlaybackClock:
+    # 播放位置时钟：累计已提交和已播放的音频时长，提交的音频全部播完时通知订阅者
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = threading.Event() # 没有未播完的音频
+        self.finished.set()
+        self.queued = 0.0 # 已提交的音频时长
+        self.played = 0.0 # 已确认播放的音频时长
+        self.running_since = None # 正在输出的片段的开始时间（无法逐样本计数的输出按时间推算位置）
+        self.running = 0.0 # 正在输出的片段时长
+        self.listeners = []
+
+    def subscribe(self, callback):
+        # 订阅播放完成事件
+        self.listeners.append(callback)
+
+    def submit(self, duration: float):
+        # 提交待播放的音频
+        with self.lock:
+            self.queued += duration
+            self.finished.clear()
+
+    def start(self, duration: float):
+        # 开始输出一个片段，位置按时间推算直到 advance 确认
+        with self.lock:
+            self.running_since = time.time()
+            self.running = duration
+
+    def extend(self, duration: float):
+        # 正在输出的片段追加音频
+        with self.lock:
+            self.running += duration
+
+    def advance(self, seconds: float):
+        # 确认播放了 seconds 秒（逐样本计数，或片段播放结束）
+        with self.lock:
+            self.played += seconds
+            self.running_since = None
+            self.running = 0.0
+            done = self.played >= self.queued - 1e-6
+            if done:
+                self.queued = self.played = 0.0
+                self.finished.set()
+        if done:
+            for callback in self.listeners:
+                callback()
+
+    def position(self) -> float:
+        # 已提交音频中当前的播放位置（秒）
+        with self.lock:
+            if self.running_since is None:
+                return self.played
+            return self.played + min(time.time() - self.running_since, self.running)
+
+    def remaining(self) -> float:
+        # 还未播放的音频时长（秒）
+        return max(0.0, self.queued - self.position())
 
 class AudioPlayer:
     def __init__(self):
         self.audio_queue = queue.Queue()
+        self.clock = PlaybackClock() # 播放位置和完成事件
+        self.engine = None # 进程内输出引擎，第一次播放时创建
+        self.engine_checked = False
         self.is_playing = False
         self.running = True  # 控制播放线程的开关
         self.thread = threading.Thread(target=self._play_loop, daemon=True)
         self.thread.start()
 
+        # 流式播放状态
+        self.reader = FrameReader()
+        self.stream_condition = threading.Condition()
+        self.stream_proc = None
+        self.stream_pending = [] # 抖动缓冲中待写入的完整帧
+        self.stream_pending_duration = 0.0
+        self.stream_arrival = None # 本段首个音频块到达时间
+        self.stream_started = None # 连续播放的起点（播完或欠载后重新计时）
+        self.stream_written = 0.0 # 起点之后已写入的音频时长
+        self.stream_ended = False
+        self.stream_first = False # 本段还没有写出音频
+        self.stream_stats = {"streams": 0, "first_audio_ms": 0.0, "max_first_audio_ms": 0.0, "underruns": 0} # 流式播放统计
+        self.stream_thread = threading.Thread(target=self._stream_loop, daemon=True)
+        self.stream_thread.start()
+
     def is_installed(self, lib_name: str) -> bool:
         return shutil.which(lib_name) is not None
 
+    def output_engine(self):
+        # 按 AUDIO_BACKEND 创建进程内输出引擎，不可用时返回 None 使用 ffplay
+        if not self.engine_checked:
+            self.engine_checked = True
+            if AUDIO_BACKEND == "engine" or (AUDIO_BACKEND == "auto" and audio_engine.miniaudio is not None):
+                try:
+                    self.engine = audio_engine.OutputEngine(self.clock)
+                except Exception:
+                    if AUDIO_BACKEND == "engine":
+                        raise
+        return self.engine
+
     def add_audio(self, audio: bytes):
         # 把音频数据加入队列
-        self.audio_queue.put(audio)
+        duration = mp3_duration(audio)
+        self.output_engine()
+        self.clock.submit(duration) # 立即登记，解码完成前播放时钟也不会报告播完
+        self.audio_queue.put((audio, duration))
+
+    def feed(self, chunk: bytes) -> float:
+        # 流式模式：把收到的音频块切成完整帧放进抖动缓冲，返回新增的音频时长
+        frames, duration = self.reader.feed(chunk)
+        self.output_engine()
+        with self.stream_condition:
+            if self.stream_arrival is None or self.stream_ended: # 新的一段音频流
+                self.stream_arrival = time.time()
+                self.stream_ended = False
+                self.stream_first = True
+            if frames:
+                self.clock.submit(duration)
+                self.stream_pending.append(frames)
+                self.stream_pending_duration += duration
+            self.stream_condition.notify()
+        return duration
+
+    def end_stream(self):
+        # 当前音频流结束：不再等待抖动缓冲，剩余帧全部写出
+        with self.stream_condition:
+            self.reader.reset()
+            self.stream_ended = True
+            self.stream_condition.notify()
 
     @property
     def is_playing(self):
-        return self._is_playing
+        return self._is_playing or not self.clock.finished.is_set()
     
     @is_playing.setter
     def is_playing(self, value):
@@ -30,12 +157,24 @@ class AudioPlayer:
         # 播放队列中的音频 
         while self.running:
             try:
-                audio = self.audio_queue.get(timeout=0.1) 
-                if audio is None:  # 退出信号
+                item = self.audio_queue.get(timeout=0.1) 
+                if item is None:  # 退出信号
                     break
+                audio, duration = item
+                if self.engine:
+                    try:
+                        self.engine.play(audio, duration) # 写入环形缓冲后立即处理下一个片段，无缝衔接
+                        continue
+                    except Exception: # 进程内解码失败时用 ffplay 播放这一段
+                        pass
+
                 self.is_playing = True
-                self._play_audio(audio)
-                self.is_playing = False
+                self.clock.start(duration)
+                try:
+                    self._play_audio(audio)
+                finally:
+                    self.clock.advance(duration) # ffplay 退出即播放结束
+                    self.is_playing = False
             except queue.Empty:
                 continue  # 没有新音频就继续等待
 
@@ -52,4 +191,82 @@ class AudioPlayer:
             stderr=subprocess.PIPE,
         )
         proc.communicate(input=audio)
-        proc.poll()
\ No newline at end of file
+        proc.poll()
+
+    def _stream_ready(self, now):
+        # 抖动缓冲是否可以写出
+        if not self.stream_pending:
+            return False
+        if self.stream_started is not None or self.stream_ended: # 已在播放或流已结束
+            return True
+        return self.stream_pending_duration >= JITTER_TARGET or now - self.stream_arrival >= JITTER_MAX_WAIT
+
+    def _stream_loop(self):
+        # 把抖动缓冲中的帧写入常驻 ffplay 进程（或进程内引擎），ffplay 按写入的时长推进播放时钟
+        while self.running:
+            first = False
+            with self.stream_condition:
+                if self.stream_started is None and not self.stream_pending: # 空闲时等待新数据，不轮询
+                    self.stream_condition.wait()
+                else:
+                    self.stream_condition.wait(timeout=0.01)
+                now = time.time()
+                if self.stream_started is not None and now >= self.stream_started + self.stream_written: # 已写入的音频播放完毕
+                    if not self.engine:
+                        self.clock.advance(self.stream_written)
+                    self.stream_started, self.stream_written = None, 0.0
+                    if self.stream_ended and not self.stream_pending: # 本段结束
+                        self.stream_arrival, self.stream_ended = None, False
+                    else: # 新数据还没到，发生欠载
+                        self.stream_stats["underruns"] += 1
+
+                if not self._stream_ready(now):
+                    continue
+
+                if self.stream_first: # 本段首次写出音频
+                    first_audio_ms = (now - self.stream_arrival) * 1000
+                    self.stream_stats["streams"] += 1
+                    self.stream_stats["first_audio_ms"] = first_audio_ms
+                    self.stream_stats["max_first_audio_ms"] = max(self.stream_stats["max_first_audio_ms"], first_audio_ms)
+                    self.stream_first = False
+                    first = True
+
+                if self.stream_started is None:
+                    self.stream_started = now
+                    if not self.engine:
+                        self.clock.start(self.stream_pending_duration)
+                elif not self.engine:
+                    self.clock.extend(self.stream_pending_duration)
+
+                data, duration = b"".join(self.stream_pending), self.stream_pending_duration
+                self.stream_written += self.stream_pending_duration
+                self.stream_pending.clear()
+                self.stream_pending_duration = 0.0
+
+            self._write_stream(data, first, duration)
+
+    def _write_stream(self, data: bytes, first: bool, duration: float):
+        # 写入常驻 ffplay 进程（进程退出时重新启动），或由进程内引擎解码
+        if self.engine:
+            if first:
+                self.engine.end_stream() # 新的音频流不接续上一段的帧
+            try:
+                self.engine.stream(data, duration)
+            except Exception: # 无法解码的数据直接丢弃，不再计入播放时钟
+                self.clock.advance(duration)
+            return
+
+        if self.stream_proc is None or self.stream_proc.poll() is not None:
+            if not self.is_installed("ffplay"):
+                raise ValueError("需要安装 ffmpeg (ffplay) 才能播放音频！")
+            self.stream_proc = subprocess.Popen(
+                args=STREAM_ARGS,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        try:
+            self.stream_proc.stdin.write(data)
+            self.stream_proc.stdin.flush()
+        except OSError:
+            self.stream_proc = None # 管道断开，下次写入时重启
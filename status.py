@@ -1,6 +1,16 @@
+import threading
+
 current_status = "" # 当前状态
 is_processing = False # 处理事件状态
 
+# 回合状态：空闲 → 生成回复 → 播放语音 → 空闲
+IDLE = "idle"
+GENERATING = "generating"
+SPEAKING = "speaking"
+turn_state = IDLE # 当前回合状态
+work_pending = True # 有新的聊天记录或语音输入等待处理
+turn_condition = threading.Condition() # 状态变化和新任务的通知
+
 def update_status(new_status: str):
     # 更新状态
     global current_status
@@ -8,9 +18,35 @@ def update_status(new_status: str):
         print(new_status)
         current_status = new_status
 
+def set_turn_state(state: str):
+    # 切换回合状态并唤醒等待的线程
+    global turn_state, is_processing, work_pending
+    with turn_condition:
+        turn_state = state
+        is_processing = state != IDLE
+        if state in (IDLE, SPEAKING):
+            work_pending = True # 回合结束或开始播放时检查积压的问题（播放时可预生成）
+        turn_condition.notify_all()
+
 def processing(status: bool = None):
     # 修改状态
-    global is_processing
     if status is not None:  # 只有在传入参数时才修改状态
-        is_processing = status
-    return is_processing  # 返回当前状态
\ No newline at end of file
+        set_turn_state(GENERATING if status else IDLE)
+    return is_processing  # 返回当前状态
+
+def notify_work():
+    # 有新的待处理问题时调用，空闲时立即唤醒调度
+    global work_pending
+    with turn_condition:
+        work_pending = True
+        turn_condition.notify_all()
+
+def wait_for_turn(timeout: float = None, allow_speaking: bool = False) -> bool:
+    # 等待回合空闲（allow_speaking 时播放中也可以）且有新任务，返回 False 表示超时
+    global work_pending
+    states = (IDLE, SPEAKING) if allow_speaking else (IDLE,)
+    with turn_condition:
+        ready = turn_condition.wait_for(lambda: turn_state in states and work_pending, timeout=timeout)
+        if ready:
+            work_pending = False
+        return ready
\ No newline at end of file
@@ -8,7 +8,7 @@ from status import update_status, processing
 from dotenv import load_dotenv
 import keyboard
 import memory
-from play import AudioPlayer
+from tts import player # 与 TTS 共用播放器，播放状态才准确
 
 # 加载环境变量
 load_dotenv()
@@ -27,7 +27,6 @@ CHANNELS = 1
 p = pyaudio.PyAudio() # 初始化 pyaudio
 stream = p.open(format=pyaudio.paInt16, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
 is_processing = False # 处理状态
-player = AudioPlayer()
 
 def on_close(ws, close_status_code, close_msg):
     # 连接关闭时触发
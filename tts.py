@@ -5,11 +5,10 @@ import base64
 import threading
 import time
 from dotenv import load_dotenv
-from status import update_status, processing
+from status import update_status, processing, set_turn_state, SPEAKING
 import queue
-from pydub import AudioSegment
+from collections import deque
 from play import AudioPlayer
-import tempfile
 import word 
 
 # 加载环境变量
@@ -20,8 +19,10 @@ ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 VOICE_ID = "hkfHEbBvdQFNX4uWHqRF" 
 MODEL_ID = "eleven_flash_v2_5"
 
-request_payload = {
-    "text": "",
+TTS_URI = os.getenv("ELEVENLABS_WS_URL", f"wss://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}/stream-input?model_id={MODEL_ID}&inactivity_timeout=180") # 可指向本地模拟服务器
+
+request_payload = { # 连接打开后发送的初始化消息
+    "text": " ",
     "voice_settings": {
         "stability": 0.5, # 降低稳定性，加快生成速度
         "similarity_boost": 0.8, # 提高相似度，减少计算量
@@ -31,31 +32,132 @@ request_payload = {
         "chunk_length_schedule": [120, 160, 250, 290], # 建议使用官方配置
         },
     "xi_api_key": ELEVENLABS_API_KEY,
-    "flush": True  # 立即输出语音，减少等待时间
 }
 
-ws_global = None  # 全局 WebSocket 连接
-lock = threading.Lock()  # 线程锁
-
-buffer = [] # 实时缓存的字体
-buffer_time = 0 # 开始缓存的时间
-is_waiting = False # 等待状态
-is_pending = False # 预处理事件
-backup_time = None # 播放开始时间备份
+active = None # 本轮回复使用的连接
+spare = None # 预热的备用连接，下一轮直接使用
+CONNECT_TIMEOUT = 5 # 等待连接打开的最长时间（秒）
+KEEP_ALIVE_INTERVAL = 15 # 心跳间隔（秒）
+
+buffer = [] # 实时缓存的分句
+buffer_time = 0 # 最近一次缓存分句的时间
+text_ready = threading.Event() # 有新分句或本轮文本结束
+reply_done = False # 本轮文本已全部推送
+unflushed = False # 已发送但还没要求立即生成的文本
+sentence_end = False # 缓存的最后一个分句是完整的句子
+is_waiting = False # 等待状态：本轮已发送文本，音频还没全部交给播放器
+last_activity = 0 # 最近一次发送文本或收到音频的时间
+BUFFER_IDLE = 0.6 # 文本停顿超过该时长时要求立即生成已发送的文本
+TTS_TIMEOUT = 10 # 超过该时长没有收到音频，放弃本轮
 audio_queue = queue.Queue()  # 音频数据队列
-start_time = None  # 记录播放开始时间
-estimated_duration = 0  # 记录音频总时长
+END_OF_REPLY = object() # 本轮音频结束标记
 player = AudioPlayer() # 初始化播放器
-display_word = "" # 用于前端显示的字体
+STREAM_PLAYBACK = False # 流式播放：音频块到达即送入常驻播放进程，不再等待 1 秒静默后合并
+spoken = deque() # 已发送、等待显示的分句：(起始字符位置, 文本)
+sent_chars = 0 # 本轮已发送的字符数
+aligned_chars = 0 # 本轮已收到音频的字符数
+reply_start = None # 本轮第一次发送文本的时间
+tts_stats = {"replies": 0, "handshakes": 0, "cold_starts": 0, "handshake_wait_ms": 0.0, "first_audio_ms": 0.0, "max_first_audio_ms": 0.0} # 连接和首音统计
+
+class TTSConnection:
+    # 一条 ElevenLabs stream-input 连接：打开后立即发送初始化消息，整轮回复共用
+    def __init__(self):
+        self.ready = threading.Event()
+        self.closed = threading.Event()
+        self.ws = websocket.WebSocketApp(
+            TTS_URI,
+            on_open=self.on_open,
+            on_message=on_message,
+            on_close=self.on_close,
+            on_error=on_error
+        )
+        tts_stats["handshakes"] += 1
+        threading.Thread(target=self.ws.run_forever, daemon=True).start()
+
+    def on_open(self, ws):
+        # 连接成功后发送语音设置，之后可以直接发送文本
+        try:
+            ws.send(json.dumps(request_payload))
+            self.ready.set()
+        except Exception as e:
+            update_status(f"Elevenlabs WebSocket 初始化失败：{e}")
+
+    def on_close(self, ws, close_status_code, close_msg):
+        # 连接关闭：备用连接重新预热，本轮连接异常关闭时结束本轮
+        #update_status(f"Elevenlabs WebSocket 连接关闭：{close_status_code}, {close_msg}")
+        self.closed.set()
+        if self is spare:
+            time.sleep(1) # 避免断网时不断重连
+            warm_spare()
+        elif self is active:
+            finish_reply_audio()
+
+    def send(self, payload):
+        self.ws.send(json.dumps(payload))
+
+def warm_spare():
+    # 预先建立下一轮使用的连接，省去握手时间
+    global spare
+    try:
+        spare = TTSConnection()
+    except Exception as e:
+        update_status(f"Elevenlabs WebSocket 连接失败：{e}")
+
+def start_reply():
+    # 本轮第一次发送文本：启用预热好的连接，并预热下一条
+    global active, spare, is_waiting, reply_start, sent_chars, aligned_chars
+
+    connection, spare = spare, None
+    if connection is None or connection.closed.is_set():
+        connection = TTSConnection()
+    if not connection.ready.is_set():
+        tts_stats["cold_starts"] += 1
+    active = connection
+    warm_spare()
+
+    reply_start = time.time()
+    is_waiting = True
+    sent_chars = aligned_chars = 0
+    spoken.clear()
+    tts_stats["replies"] += 1
+    ready = active.ready.wait(CONNECT_TIMEOUT)
+    tts_stats["handshake_wait_ms"] = (time.time() - reply_start) * 1000
+    return ready
+
+def close_reply():
+    # 本轮文本发送完毕：发送空文本，服务器生成剩余音频后返回 isFinal 并关闭连接
+    global reply_done
+    reply_done = False
+    if active is None: # 本轮没有任何文本
+        check_turn_finished()
+        return
+    try:
+        active.send({"text": ""})
+    except Exception as e:
+        update_status(f"Elevenlabs WebSocket 发送消息失败：{e}")
+        finish_reply_audio()
+
+def finish_reply_audio():
+    # 本轮音频全部收到
+    global active, is_waiting
+    active = None
+    show_spoken(sent_chars) # 显示剩余的分句
+    if STREAM_PLAYBACK:
+        player.end_stream() # 写出抖动缓冲
+        is_waiting = False # 解除等待状态
+        check_turn_finished()
+    else:
+        audio_queue.put(END_OF_REPLY) # 立即合并剩余音频，不再等待 1 秒静默
 
 def audio_player():
     # 音频播放线程，持续从队列获取音频片段，合并并播放
-    global start_time, estimated_duration
+    global is_waiting
 
     while True:
         try:
             chunks = []
             start_time_for_chunk = time.time()
+            finished = False
 
             while True:
                 try:
@@ -63,6 +165,9 @@ def audio_player():
                 except queue.Empty:
                     chunk = None
 
+                if chunk is END_OF_REPLY:
+                    finished = True
+                    break
                 if chunk:
                     chunks.append(chunk)
                     start_time_for_chunk = time.time()
@@ -71,79 +176,57 @@ def audio_player():
                     break  
 
             if chunks:
-                merged_audio = b"".join(chunks)  # 合并音频片段
-                fd, temp_audio_path = tempfile.mkstemp(suffix=".mp3") # 使用 tempfile 生成唯一临时文件，避免冲突
-                os.close(fd)  # 关闭文件描述符，防止文件锁定
-
-                try:
-                    with open(temp_audio_path, "wb") as temp_mp3:
-                        temp_mp3.write(merged_audio)
-
-                    time.sleep(0.1)  # 让操作系统完成文件刷新（Windows 可能需要）
-
-                    audio = AudioSegment.from_file(temp_audio_path, format="mp3") # 解析 MP3 获取时长
-                    estimated_duration = len(audio) / 1000
-                    start_time = time.time()
-                    
-                    with open(temp_audio_path, "rb") as temp_mp3: # 读取 MP3 文件的二进制数据
-                        audio_bytes = temp_mp3.read()
-
-                    player.add_audio(audio_bytes)  # 传入 bytes 数据
-                    word.add_text(display_word) # 打印信息到前端
-                    update_status(display_word) # 终端打印信息
-
-                finally:
-                    time.sleep(0.1)  # 给 ffplay 释放文件的时间
-                    os.remove(temp_audio_path)
-                    chunks.clear()  # 清空已合并的音频片段
-                    merged_audio = b""  # 清空临时音频片段
+                audio_bytes = b"".join(chunks)  # 合并音频片段
+                player.add_audio(audio_bytes)  # 传入 bytes 数据，播放器解析时长并推进播放时钟
+            if finished:
+                is_waiting = False # 解除等待状态
+                check_turn_finished()
 
         except Exception as e:
             update_status(f"音频播放线程异常：{e}")
 
-def check_playback_progress():
-    # 后台线程：监测播放进度，70% 时清空队列并等待新数据
-    global start_time, estimated_duration, is_waiting, is_pending, backup_time
-
-    while True:
-        if start_time and estimated_duration > 0:
-            is_waiting = False # 解除等待状态
-            elapsed_time = time.time() - start_time
-            progress = elapsed_time / estimated_duration if estimated_duration > 0 else 0
-
-            if progress > 0.7:
-                audio_queue.queue.clear() # 清空队列
-                backup_time = time.time() # 备份播放时间
-                start_time = None  # 重置播放时间
-                estimated_duration = 0  # 重置总时长
-                is_pending = True # 启动预处理事件
-
-        elif is_pending and time.time() - backup_time > 0.6: # TTS 事件结束时触发 
-            is_pending = False
-            backup_time = None
-            processing(False) # 取消处理状态
+def check_turn_finished():
+    # 音频全部播完、没有待发送的文本且不在等待合成时结束本轮
+    if not buffer and not is_waiting and player.clock.finished.is_set():
+        processing(False) # 取消处理状态
 
-        time.sleep(0.1) 
+def show_spoken(chars):
+    # 收到对应字符的音频后显示分句
+    global aligned_chars
+    aligned_chars += chars
+    while spoken and spoken[0][0] < aligned_chars:
+        _, text = spoken.popleft()
+        word.add_text(text) # 打印信息到前端
+        update_status(text) # 终端打印信息
 
 def on_message(ws, message):
     # 接收收到的音频数据
+    global reply_start, last_activity
     try:
         data = json.loads(message)
         if "audio" in data and isinstance(data["audio"], str):
             chunk = base64.b64decode(data["audio"])
-            audio_queue.put(chunk)  # 添加音频到播放队列
-    
-    except Exception as e:
-        update_status(f"Elevenlabs WebSocket 处理消息时出错：{e}")
+            last_activity = time.time()
+            if reply_start is not None: # 本轮第一个音频块
+                first_audio_ms = (time.time() - reply_start) * 1000
+                tts_stats["first_audio_ms"] = first_audio_ms
+                tts_stats["max_first_audio_ms"] = max(tts_stats["max_first_audio_ms"], first_audio_ms)
+                reply_start = None
+                set_turn_state(SPEAKING) # 进入播放阶段
 
-def on_open(ws):
-    # 连接成功打开时的事件
-    pass
+            if STREAM_PLAYBACK:
+                player.feed(chunk)
+            else:
+                audio_queue.put(chunk)  # 添加音频到播放队列
 
-def on_close(ws, close_status_code, close_msg):
-    # 连接关闭时的事件
-    #update_status(f"Elevenlabs WebSocket 连接关闭：{close_status_code}, {close_msg}")
-    connect_ws()  # 重新连接 WebSocket
+            alignment = data.get("alignment") or {}
+            show_spoken(len(alignment.get("chars") or [])) # 按对齐信息显示已经有语音的分句
+
+        if data.get("isFinal") and active is not None and ws is active.ws:
+            finish_reply_audio()
+
+    except Exception as e:
+        update_status(f"Elevenlabs WebSocket 处理消息时出错：{e}")
 
 def on_error(ws, error):
     # 连接发生错误时打印报错
@@ -151,80 +234,96 @@ def on_error(ws, error):
     pass
 
 def keep_alive():
-    # 发送心跳包以保持 WebSocket 连接 
+    # 定时发送空格，保持备用连接不被服务器关闭
     while True:
+        time.sleep(KEEP_ALIVE_INTERVAL)
         try:
-            time.sleep(15)
-            request_payload["text"] = " "
-            ws_global.send(json.dumps(request_payload))
+            if spare is not None and spare.ready.is_set():
+                spare.send({"text": " "})
         except Exception as e:
             pass
 
-def connect_ws():
-    # 建立 WebSocket 连接 
-    global ws_global
-
-    uri = f"wss://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}/stream-input?model_id={MODEL_ID}"
-    
-    try:
-        ws_global = websocket.WebSocketApp(
-            uri,
-            on_open=on_open,
-            on_message=on_message,
-            on_close=on_close,
-            on_error=on_error
-        )
-        threading.Thread(target=ws_global.run_forever, daemon=True).start()
-
-    except Exception as e:
-        update_status(f"Elevenlabs WebSocket 连接失败：{e}")
+def join_segments(segments):
+    # 拼接分句，英文分句之间补回空格
+    text = ""
+    for segment in segments:
+        if text and text[-1].isascii() and segment[0].isascii():
+            text += " "
+        text += segment
+    return text
 
 def process_tts(): 
-    # 处理 TTS 发送内容和更新状态
-    global buffer, is_waiting, is_pending
-
-    chunk = buffer[:40] if len(buffer) >= 40 else buffer[:]  # 取前 40 个，或者所有剩余文本
-    text_to_speech_ws(''.join(chunk))
-    buffer = buffer[len(chunk):]  # 删除已发送部分
-    is_waiting = True # 开启等待状态
-    is_pending = False # 关闭预处理
-
-def add_buffer(text):
-    # 把文本加入到 buffer 列表
-    global buffer, buffer_time
+    # 把缓存的分句送入本轮连接，本轮第一段和完整的句子要求立即生成以缩短首音时间
+    global buffer, unflushed
+
+    count = len(buffer)
+    text = join_segments(buffer[:count])
+    buffer = buffer[count:]  # 删除已发送部分
+
+    first = active is None
+    if first and not start_reply():
+        update_status("Elevenlabs WebSocket 连接超时")
+        return
+    flush = first or sentence_end # 句子已经完整，不必等服务器凑够生成长度
+    text_to_speech_ws(text, flush=flush)
+    unflushed = not flush
+
+def add_buffer(text, kind="clause"):
+    # 把分句加入到 buffer 列表（订阅 normalize.TextStream 的分句事件）
+    global buffer, buffer_time, reply_done, sentence_end
     buffer.append(text)
     buffer_time = time.time()
+    sentence_end = kind == "sentence"
+    reply_done = False # 新一轮的文本
+    text_ready.set()
+
+def end_reply():
+    # 本轮文本已全部推送，发送完缓存后结束本轮连接
+    global reply_done
+    reply_done = True
+    text_ready.set()
 
 def flush_buffer(): 
-    # 实时检查 buffer，发送缓存的文本
-    while True:
-        # 如果超出缓存限定时间没有任何变化
-        if len(buffer) > 0 and time.time() - buffer_time > 0.6 and not is_pending and not is_waiting and estimated_duration == 0 and backup_time == None: 
-            process_tts() 
-        elif len(buffer) >= 40 and not is_waiting and estimated_duration == 0: # 40 字且不是在等待状态 
-            process_tts() 
-        elif is_pending and len(buffer) > 0 and time.time() - backup_time > 0.4: # pending 状态时限内没触发 process_tts()
-            process_tts() 
+    # 新分句立即送入本轮连接；文本停顿时要求立即生成，本轮文本结束后关闭输入
+    global unflushed, is_waiting
 
-        time.sleep(0.1) 
+    while True:
+        text_ready.wait(timeout=0.1)
+        text_ready.clear()
 
-def text_to_speech_ws(segment):
-    # 实时 WebSocket TTS 
-    global request_payload, display_word
+        if len(buffer) > 0:
+            process_tts() 
+        if reply_done and not buffer:
+            close_reply()
+        elif unflushed and active is not None and time.time() - buffer_time > BUFFER_IDLE: # 文本停顿，不再等待凑够生成长度
+            text_to_speech_ws(" ", flush=True)
+            unflushed = False
+        elif is_waiting and time.time() - last_activity > TTS_TIMEOUT: # 合成失败，没有音频返回
+            if active is not None:
+                active.ws.close()
+            is_waiting = False
+            check_turn_finished()
+
+def text_to_speech_ws(segment, flush=False):
+    # 把文本送入本轮连接，flush 时要求服务器立即生成已收到的文本
+    global sent_chars, last_activity
 
-    with lock:
-        try:
-            request_payload["text"] = segment
-            ws_global.send(json.dumps(request_payload))
-            display_word = segment
-            ws_global.send(json.dumps({"text": ""})) # 关闭当前 Websocket
+    try:
+        payload = {"text": segment + " ", "try_trigger_generation": True}
+        if flush:
+            payload["flush"] = True
+        active.send(payload)
+        if segment.strip():
+            spoken.append((sent_chars, segment))
+            sent_chars += len(segment) + 1
+        last_activity = time.time()
 
-        except Exception as e:
-            update_status(f"Elevenlabs WebSocket 发送消息失败：{e}")
+    except Exception as e:
+        update_status(f"Elevenlabs WebSocket 发送消息失败：{e}")
 
-connect_ws()
+warm_spare()
+player.clock.subscribe(check_turn_finished) # 播放完成时检查本轮是否结束
 # 确保每个线程只启动一次 
 threading.Thread(target=flush_buffer, daemon=True).start()
 threading.Thread(target=audio_player, daemon=True).start()
-threading.Thread(target=check_playback_progress, daemon=True).start()
 threading.Thread(target=keep_alive, daemon=True).start()
\ No newline at end of file
@@ -0,0 +1,173 @@
+import os
+import random
+import time
+import requests
+from collections import OrderedDict
+from dotenv import load_dotenv
+from status import update_status
+import memory
+
+load_dotenv()  # 加载 .env 文件
+YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY") # YouTube API 密钥
+YOUTUBE_API_URL = os.getenv("YOUTUBE_API_URL", "https://www.googleapis.com/youtube/v3") # 可指向本地模拟服务器
+
+live_chat_id = "" # Youtube 直播视频 ID
+next_page_token = None # 下一页令牌
+
+AUTHOR_CACHE_SIZE = 5000 # 发言者名称缓存容量
+AUTHOR_CACHE_TTL = 3600 # 发言者名称缓存有效期（秒）
+author_cache = OrderedDict() # 频道 ID -> (显示名称, 过期时间)
+author_stats = {"hits": 0, "misses": 0, "api_calls": 0, "calls_saved": 0} # 发言者名称缓存统计
+
+POLL_MIN_INTERVAL = 1.0 # 服务器没有给出间隔时的默认轮询间隔（秒）
+BACKOFF_BASE = 2.0 # 出错后的初始退避时间（秒）
+BACKOFF_MAX = 60.0 # 最长退避时间（秒）
+poll_failures = 0 # 连续失败次数
+PAID_MESSAGE_TYPES = ("superChatEvent", "superStickerEvent") # 超级留言类型
+poll_stats = {"requests": 0, "failures": 0, "pages": 0, "messages": 0, "last_interval": 0.0}
+
+session = requests.Session() # 复用 TCP + TLS 连接
+session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+def get_live_chat_id():
+    # 获取 Live Chat ID
+    try:
+        url = f"{YOUTUBE_API_URL}/videos?id={live_chat_id}&part=liveStreamingDetails&key={YOUTUBE_API_KEY}"
+        response = session.get(url, timeout=10).json()
+        return response.get("items", [{}])[0].get("liveStreamingDetails", {}).get("activeLiveChatId", None)
+
+    except Exception as e:
+        update_status(f"获取 Youtube Live Chat ID 失败：{e}")
+        return None
+
+def get_cached_author(channel_id):
+    # 从缓存读取发言者名称，过期则删除
+    cached = author_cache.get(channel_id)
+    if cached is None:
+        return None
+
+    name, expires = cached
+    if time.time() > expires:
+        del author_cache[channel_id]
+        return None
+
+    author_cache.move_to_end(channel_id) # 标记为最近使用
+    return name
+
+def cache_author(channel_id, name):
+    # 写入发言者名称缓存，超出容量时淘汰最久未使用的
+    author_cache[channel_id] = (name, time.time() + AUTHOR_CACHE_TTL)
+    author_cache.move_to_end(channel_id)
+    while len(author_cache) > AUTHOR_CACHE_SIZE:
+        author_cache.popitem(last=False)
+
+def get_channel_names(channel_ids):
+    # 批量获取频道显示名称，每次请求最多 50 个 ID
+    names = {}
+    channel_ids = list(dict.fromkeys(channel_ids)) # 去重并保持顺序
+
+    for i in range(0, len(channel_ids), 50):
+        batch = channel_ids[i:i + 50]
+        try:
+            url = f"{YOUTUBE_API_URL}/channels?part=snippet&id={','.join(batch)}&key={YOUTUBE_API_KEY}"
+            response = session.get(url, timeout=10)
+            author_stats["api_calls"] += 1
+
+            if response.status_code != 200:
+                print(f"获取 Youtube 频道信息失败：{response.json()}")
+                continue
+
+            for item in response.json().get("items", []):
+                names[item["id"]] = item["snippet"]["title"] # 频道的显示名称
+
+        except Exception as e:
+            update_status(f"获取 Youtube 频道信息失败: {e}")
+
+    return names
+
+def resolve_authors(messages):
+    # 获取一页消息中所有发言者的显示名称：优先使用 authorDetails，其次缓存，最后批量请求
+    names = {}
+    missing = []
+
+    for message in messages:
+        channel_id = message["snippet"].get("authorChannelId", "Unknown Author")
+        display_name = message.get("authorDetails", {}).get("displayName")
+
+        if display_name:
+            cache_author(channel_id, display_name)
+            author_stats["calls_saved"] += 1
+        else:
+            display_name = get_cached_author(channel_id)
+            if display_name:
+                author_stats["hits"] += 1
+                author_stats["calls_saved"] += 1
+            else:
+                author_stats["misses"] += 1
+                missing.append(channel_id)
+
+        names[channel_id] = display_name
+
+    if missing:
+        fetched = get_channel_names(missing)
+        for channel_id, display_name in fetched.items():
+            cache_author(channel_id, display_name)
+        names.update(fetched)
+
+    return names
+
+def message_priority(message):
+    # 会员和超级留言优先回答，普通弹幕使用默认优先级
+    if message["snippet"].get("type") in PAID_MESSAGE_TYPES or message.get("authorDetails", {}).get("isChatSponsor"):
+        return 1
+    return None
+
+def backoff_delay():
+    # 指数退避 + 随机抖动，避免配额耗尽或服务异常时持续请求
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (poll_failures - 1)))
+
+def poll_live_chat(chat_id):
+    # 拉取一页聊天消息并写入缓冲区，返回距离下一次请求应等待的秒数
+    global next_page_token, poll_failures
+
+    try:
+        chat_url = f"{YOUTUBE_API_URL}/liveChat/messages?liveChatId={chat_id}&part=snippet,authorDetails&key={YOUTUBE_API_KEY}"
+        if next_page_token:
+            chat_url += f"&pageToken={next_page_token}" # 添加分页令牌
+
+        poll_stats["requests"] += 1
+        response = session.get(chat_url, timeout=10)
+        if response.status_code != 200:
+            raise RuntimeError(f"状态码 {response.status_code}")
+
+        chat_messages = response.json()
+        authors = resolve_authors(chat_messages.get('items', [])) # 获取发言者的显示名称
+
+        for message in chat_messages.get('items', []): # 遍历消息列表
+            display_message = message['snippet']['displayMessage'] # 获取显示消息
+            author_channel_id = message["snippet"].get("authorChannelId", "Unknown Author")  # Channel ID
+            display_name = authors.get(author_channel_id)
+            memory.queue_chat_record(display_name, "yt_message", display_message, message_priority(message)) # 添加消息记录到写入缓冲区
+
+        next_page_token = chat_messages.get('nextPageToken') # 获取下一页的令牌
+        poll_failures = 0
+        poll_stats["pages"] += 1
+        poll_stats["messages"] += len(chat_messages.get('items', []))
+        interval = max(chat_messages.get("pollingIntervalMillis", 0) / 1000, POLL_MIN_INTERVAL) # 遵守服务器建议的间隔
+
+    except Exception as e:
+        poll_failures += 1
+        poll_stats["failures"] += 1
+        interval = max(backoff_delay(), POLL_MIN_INTERVAL)
+        update_status(f"爬取 YouTube 消息失败：{e}，{interval:.1f} 秒后重试")
+
+    poll_stats["last_interval"] = interval
+    return interval
+
+def crawl_youtube_messages():
+    # 爬取 YouTube 聊天消息
+    chat_id = get_live_chat_id()
+
+    if chat_id:
+        while True:
+            time.sleep(poll_live_chat(chat_id))